@@ -2,19 +2,49 @@ import logging
 from mp_shared_memory import SharedMemory
 import multiprocessing
 import numpy as np
-from scipy import ndimage
 import os
 import tifffile
 import tqdm
 from blockfs import Directory, Compression
-import uuid
 import itertools
 from PIL import Image
 
-from .stack import StackBase, PType
+from .downsample import downsample_mean, downsampled_shape
+from .stack import StackBase, PType, JPEG_LUT, JPEG_THRESHOLD
 
 logger = logging.getLogger("precomputed_tif.blockfs_stack")
-directories = {}
+#
+# Per-worker state for write_level_n, installed by init_level_n_worker
+#
+SRC_DIRECTORY:Directory = None
+DEST_DIRECTORY:Directory = None
+LEVEL_N_COORDS:tuple = None
+
+
+def init_level_n_worker(src_directory, dest_directory, coords):
+    """Initialize a write_level_n worker process
+
+    The directories and the block coordinates are handed over once per
+    worker instead of once per task.
+
+    :param src_directory: the blockfs directory of the level being read
+    :param dest_directory: the blockfs directory of the level being
+    written. Its writer processes must already have been started.
+    :param coords: a tuple of x0d, x0s, x1d, x1s, xsi_max, y0d, y0s, y1d,
+    y1s, ysi_max, z0d, z0s, z1d, z1s, zsi_max
+    """
+    global SRC_DIRECTORY, DEST_DIRECTORY, LEVEL_N_COORDS
+    SRC_DIRECTORY = src_directory
+    DEST_DIRECTORY = dest_directory
+    LEVEL_N_COORDS = coords
+
+
+def write_one_level_n_star(idxs):
+    return BlockfsStack.write_one_level_n(*idxs)
+
+
+def write_stack_level_n_star(idxs):
+    return BlockfsStack.write_stack_level_n(*idxs)
 
 
 class BlockfsStack(StackBase):
@@ -22,9 +52,24 @@ class BlockfsStack(StackBase):
     DIRECTORY_FILENAME="precomputed.blockfs"
 
     def __init__(self, glob_expr, dest, ptype=PType.IMAGE,
-                 chunk_size=(64, 64, 64)):
+                 chunk_size=(64, 64, 64),
+                 compression=Compression.zstd,
+                 compression_level=3):
+        """
+
+        :param glob_expr: the glob file expression for capturing the files in
+        the stack, e.g. "/path/to/img_*.tif*"
+        :param dest: the destination root directory for the precomputed files
+        :param ptype: the precomputed type, image or segmentation
+        :param chunk_size: the block size to write, in Z, Y, X order
+        :param compression: the blockfs compression used for every level
+        :param compression_level: the compression level, e.g. 1 for faster
+        writes or higher for smaller files
+        """
         super(BlockfsStack, self).__init__(glob_expr, dest, ptype=ptype,
                                            chunk_size=chunk_size)
+        self.compression = compression
+        self.compression_level = compression_level
         if self.dtype == bool: self.dtype = np.dtype(np.uint16)
 
     def fname(self, level):
@@ -43,15 +88,27 @@ class BlockfsStack(StackBase):
         directory = self.make_l1_directory(n_cores)
         directory.create()
         directory.start_writer_processes()
-        directory_id = uuid.uuid4()
-        directories[directory_id] = directory
 
+        #
+        # Double-buffer the slabs: the tiffs for the next slab are read
+        # into one buffer while the blocks of the previous slab are
+        # written from the other.
+        #
+        shms = [SharedMemory((self.cz(), self.y_extent, self.x_extent),
+                             directory.dtype) for _ in range(2)]
         with multiprocessing.Pool(n_cores) as pool:
-            for z0a, z1a in tqdm.tqdm(list(zip(z0, z1))):
-                files = self.files[z0a:z1a]
+            pending = None
+            for idx, (z0a, z1a) in enumerate(tqdm.tqdm(list(zip(z0, z1)))):
+                shm = shms[idx % 2]
+                futures = BlockfsStack.read_slab(
+                    pool, shm, self.files[z0a:z1a])
+                if pending is not None:
+                    BlockfsStack.write_one_level_1(
+                        directory, *pending, x0, x1, y0, y1)
+                pending = (shm, futures, z0a, z1a)
+            if pending is not None:
                 BlockfsStack.write_one_level_1(
-                    pool, directory_id, files,
-                     x0, x1, y0, y1, z0a, z1a)
+                    directory, *pending, x0, x1, y0, y1)
             try:
                 acc = 0
                 for bw in directory.writers:
@@ -85,6 +142,8 @@ class BlockfsStack(StackBase):
                               y_block_size=self.cy(),
                               z_block_size=self.cz(),
                               directory_filename=directory_filename,
+                              compression=self.compression,
+                              compression_level=self.compression_level,
                               block_filenames=block_files)
         return directory
 
@@ -92,35 +151,51 @@ class BlockfsStack(StackBase):
     def read_tiff(shm, z, path):
         with shm.txn() as m:
             if '.jpeg' in path or '.jpg' in path:
+                target = m[z]
                 jarray = np.asarray(Image.open(path))
-                jarray[jarray < 20] = 0
-                m[z] = jarray
+                if jarray.dtype == np.uint8:
+                    target[:] = JPEG_LUT[jarray]
+                else:
+                    target[:] = jarray
+                    np.putmask(target, target < JPEG_THRESHOLD, 0)
             else:
-                arr = tifffile.imread(path)
-                if arr.dtype == bool: 
-                    arr = (arr.astype(np.uint16)*100)
-                m[z] = arr
+                with tifffile.TiffFile(path) as tif:
+                    series = tif.series[0]
+                    if series.dtype == m.dtype and \
+                            series.shape == m.shape[1:]:
+                        # Decode straight into the shared memory slab
+                        tif.asarray(out=m[z])
+                        return
+                    arr = tif.asarray()
+                if arr.dtype == bool:
+                    np.multiply(arr, np.uint16(100), out=m[z],
+                                casting='unsafe')
+                else:
+                    m[z] = arr
+
+    @staticmethod
+    def read_slab(pool, shm, files):
+        """Start reading a slab of tiff planes into shared memory
+
+        :param pool: the multiprocessing pool that does the reading
+        :param shm: the shared memory buffer to hold the planes
+        :param files: the paths of the planes in the slab
+        :return: a list of futures to wait on for the reads to finish
+        """
+        return [pool.apply_async(BlockfsStack.read_tiff, (shm, z, file))
+                for z, file in enumerate(files)]
 
     @staticmethod
-    def write_one_level_1(pool, directory_id, files,
-                          x0, x1, y0, y1, z0a, z1a):
-        directory = directories[directory_id]
-        x_extent = directory.x_extent
-        y_extent = directory.y_extent
-        dtype = directory.dtype
-        shm = SharedMemory((z1a - z0a, y_extent, x_extent),
-                           dtype)
-        img = np.zeros((64, y0[-1] + 64, x0[-1] + 64), dtype)
-        futures = []
-        for z, file in zip(range(z0a, z1a), files):
-            futures.append(pool.apply_async(BlockfsStack.read_tiff,
-                                            (shm, z-z0a, file)))
+    def write_one_level_1(directory, shm, futures,
+                          z0a, z1a, x0, x1, y0, y1):
         for future in futures:
             future.get()
         with shm.txn() as img:
             for (x0a, x1a), (y0a, y1a) in itertools.product(
                     zip(x0, x1), zip(y0, y1)):
-                block = img[:z1a - z0a, y0a:y1a, x0a:x1a]
+                # Copy the block out so the buffer can be reused
+                # for the slab after next.
+                block = img[:z1a - z0a, y0a:y1a, x0a:x1a].copy()
                 directory.write_block(block, x0a, y0a, z0a)
 
     def write_level_n(self, level, silent=False,
@@ -138,8 +213,6 @@ class BlockfsStack(StackBase):
         src_directory_filename = \
             os.path.join(src, BlockfsStack.DIRECTORY_FILENAME)
         src_directory = Directory.open(src_directory_filename)
-        src_directory_id = uuid.uuid4()
-        directories[src_directory_id] = src_directory
 
         z0s = self.z0(level - 1)
         z1s = self.z1(level - 1)
@@ -165,54 +238,52 @@ class BlockfsStack(StackBase):
                                    x_block_size=self.cx(),
                                    y_block_size=self.cy(),
                                    z_block_size=self.cz(),
+                                   compression=self.compression,
+                                   compression_level=self.compression_level,
                                    block_filenames=dest_block_filenames)
         dest_directory.create()
-        dest_directory_id = uuid.uuid4()
-        directories[dest_directory_id] = dest_directory
         dest_directory.start_writer_processes()
         xsi_max = self.n_x(level - 1)
         ysi_max = self.n_y(level - 1)
         zsi_max = self.n_z(level - 1)
+        coords = (x0d, x0s, x1d, x1s, xsi_max,
+                  y0d, y0s, y1d, y1s, ysi_max,
+                  z0d, z0s, z1d, z1s, zsi_max)
         if self.ptype == PType.IMAGE:
-            fn = BlockfsStack.write_one_level_n
+            fn = write_one_level_n_star
         else:
-            fn = BlockfsStack.write_stack_level_n
-        with multiprocessing.Pool(n_cores) as pool:
+            fn = write_stack_level_n_star
+        tasks = list(itertools.product(
+            range(self.n_x(level)),
+            range(self.n_y(level)),
+            range(self.n_z(level))))
+        chunksize = max(1, len(tasks) // (n_cores * 4))
+        with multiprocessing.Pool(
+                n_cores,
+                initializer=init_level_n_worker,
+                initargs=(src_directory, dest_directory, coords)) as pool:
             try:
-                futures = []
-                for xidx, yidx, zidx in itertools.product(
-                        range(self.n_x(level)),
-                        range(self.n_y(level)),
-                        range(self.n_z(level))):
-                    futures.append(pool.apply_async(
-                        fn,
-                        (src_directory_id, dest_directory_id,
-                         x0d, x0s, x1d, x1s, xidx, xsi_max,
-                         y0d, y0s, y1d, y1s, yidx, ysi_max,
-                         z0d, z0s, z1d, z1s, zidx, zsi_max)))
-                for future in tqdm.tqdm(futures):
-                    future.get()
+                for _ in tqdm.tqdm(
+                        pool.imap_unordered(fn, tasks, chunksize=chunksize),
+                        total=len(tasks)):
+                    pass
             finally:
                 dest_directory.close()
 
     @staticmethod
-    def write_one_level_n(src_directory_id, dest_directory_id,
-                          x0d, x0s, x1d, x1s, xidx, xsi_max,
-                          y0d, y0s, y1d, y1s, yidx, ysi_max,
-                          z0d, z0s, z1d, z1s, zidx, zsi_max):
-        logger.debug(f"Writing {x0s}:{x1s},{y0s}:{y1s},{z0s}:{z1s} to"
-                     f"{x0d}:{x1d},{y0d}:{y1d},{z0d}:{z1d}")
-        src_directory = directories[src_directory_id]
-        dest_directory = directories[dest_directory_id]
+    def write_one_level_n(xidx, yidx, zidx):
+        x0d, x0s, x1d, x1s, xsi_max, \
+            y0d, y0s, y1d, y1s, ysi_max, \
+            z0d, z0s, z1d, z1s, zsi_max = LEVEL_N_COORDS
+        logger.debug(f"Writing block {xidx}, {yidx}, {zidx}")
+        src_directory = SRC_DIRECTORY
+        dest_directory = DEST_DIRECTORY
         hx = src_directory.x_block_size // 2
         hy = src_directory.y_block_size // 2
         hz = src_directory.z_block_size // 2
         block = np.zeros((z1d[zidx] - z0d[zidx],
                           y1d[yidx] - y0d[yidx],
-                          x1d[xidx] - x0d[xidx]), np.uint64)
-        hits = np.zeros((z1d[zidx] - z0d[zidx],
-                         y1d[yidx] - y0d[yidx],
-                         x1d[xidx] - x0d[xidx]), np.uint64)
+                          x1d[xidx] - x0d[xidx]), dest_directory.dtype)
         for xsi1, ysi1, zsi1 in itertools.product((0, 1), (0, 1), (0, 1)):
             xsi = xsi1 + xidx * 2
             if xsi == xsi_max:
@@ -224,32 +295,23 @@ class BlockfsStack(StackBase):
             if zsi == zsi_max:
                 continue
             src_block = src_directory.read_block(x0s[xsi], y0s[ysi], z0s[zsi])
-            for offx, offy, offz in \
-                    itertools.product((0, 1), (0, 1), (0, 1)):
-                dsblock = src_block[offz::2, offy::2, offx::2]
-                block[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                xsi1 * hx:xsi1 * hx + dsblock.shape[2]] += \
-                    dsblock.astype(block.dtype)
-                hits[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                xsi1 * hx:xsi1 * hx + dsblock.shape[2]] += 1
-        block[hits > 0] = block[hits > 0] // hits[hits > 0]
+            dz, dy, dx = downsampled_shape(src_block.shape)
+            downsample_mean(src_block,
+                            block[zsi1 * hz:zsi1 * hz + dz,
+                                  ysi1 * hy:ysi1 * hy + dy,
+                                  xsi1 * hx:xsi1 * hx + dx])
         dest_directory.write_block(block, x0d[xidx], y0d[yidx], z0d[zidx])
 
     @staticmethod
-    def write_stack_level_n(src_directory_id, dest_directory_id,
-                          x0d, x0s, x1d, x1s, xidx, xsi_max,
-                          y0d, y0s, y1d, y1s, yidx, ysi_max,
-                          z0d, z0s, z1d, z1s, zidx, zsi_max):
-        src_directory = directories[src_directory_id]
-        dest_directory = directories[dest_directory_id]
+    def write_stack_level_n(xidx, yidx, zidx):
+        x0d, x0s, x1d, x1s, xsi_max, \
+            y0d, y0s, y1d, y1s, ysi_max, \
+            z0d, z0s, z1d, z1s, zsi_max = LEVEL_N_COORDS
+        src_directory = SRC_DIRECTORY
+        dest_directory = DEST_DIRECTORY
         block = np.zeros((z1d[zidx] - z0d[zidx],
                           y1d[yidx] - y0d[yidx],
-                          x1d[xidx] - x0d[xidx]), np.uint64)
-        hits = np.zeros((z1d[zidx] - z0d[zidx],
-                         y1d[yidx] - y0d[yidx],
-                         x1d[xidx] - x0d[xidx]), np.uint64)
+                          x1d[xidx] - x0d[xidx]), dest_directory.dtype)
         hx = src_directory.x_block_size // 2
         hy = src_directory.y_block_size // 2
         hz = src_directory.z_block_size // 2
@@ -267,11 +329,8 @@ class BlockfsStack(StackBase):
             for offx, offy, offz in \
                     itertools.product((0, 1), (0, 1), (0, 1)):
                 dsblock = src_block[offz::2, offy::2, offx::2]
-                block[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                      ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                      xsi1 * hx:xsi1 * hx + dsblock.shape[2]] = np.maximum(
-                    block[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                          ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                          xsi1 * hx:xsi1 * hx + dsblock.shape[2]],
-                    dsblock.astype(block.dtype))
+                view = block[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
+                             ysi1 * hy:ysi1 * hy + dsblock.shape[1],
+                             xsi1 * hx:xsi1 * hx + dsblock.shape[2]]
+                np.maximum(view, dsblock, out=view)
         dest_directory.write_block(block, x0d[xidx], y0d[yidx], z0d[zidx])
@@ -2,6 +2,10 @@
 
 """
 
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import itertools
 import json
 from urllib.request import urlopen, urlparse
@@ -10,64 +14,194 @@ import requests
 import numpy as np
 import os
 import tifffile
+import threading
 import time
 
 import zarr
 
 __cache = {}
+#
+# The number of threads in the shared pool that fetches chunks
+#
+MAX_WORKERS = 16
 
-class Scale:
-    """Represents a mipmap level on the precomputed data source"""
 
-    def __init__(self, d):
-        self.d = d
+def make_session(pool_size=32) -> requests.Session:
+    """Make a keep-alive session for fetching http(s) chunks
 
-    @property
-    def chunk_sizes(self):
-        """The dimensions of one chunk"""
-        return self.d["chunk_sizes"][0]
+    :param pool_size: the number of connections to keep open per host
+    """
+    session = requests.Session()
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+
+#
+# The session used for http(s) fetches when none is given
+#
+SESSION = make_session()
+#
+# The thread pool shared by all read_chunk calls
+#
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+#
+# The thread pool that reads the overlapping volumes of a DANDI range at
+# the same time. Its tasks wait on EXECUTOR, so it must not be EXECUTOR.
+#
+SOURCE_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+class ChunkCache:
+    """A thread-safe cache of decoded chunks, evicting least recently used
 
-    @property
-    def encoding(self):
-        return self.d["encoding"]
+    """
 
-    @property
-    def key(self):
-        """The key for data retrieval"""
-        return self.d["key"]
+    def __init__(self, max_bytes):
+        """
 
-    @property
-    def shape(self):
-        """The voxel dimensions (the "size" field)"""
-        return self.d["size"]
+        :param max_bytes: the maximum number of bytes of chunk data to hold.
+        Zero disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
 
-    @property
-    def offset(self):
-        """The offset of the dataset in the larger space in voxels"""
-        return self.d["voxel_offset"]
+    def get(self, key):
+        """Get a chunk from the cache
+
+        :param key: the chunk's key
+        :return: the chunk or None if not cached
+        """
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                self.chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key, chunk):
+        """Add a chunk to the cache
+
+        :param key: the chunk's key. The first element should be the URL
+        of the data source.
+        :param chunk: the decoded chunk. It is made read-only.
+        """
+        if chunk.nbytes > self.max_bytes:
+            return
+        chunk.flags.writeable = False
+        with self.lock:
+            old_chunk = self.chunks.pop(key, None)
+            if old_chunk is not None:
+                self.nbytes -= old_chunk.nbytes
+            self.chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old_chunk = self.chunks.popitem(last=False)
+                self.nbytes -= old_chunk.nbytes
+
+    def clear(self, url=None):
+        """Remove chunks from the cache
+
+        :param url: remove the chunks for this data source or None (default)
+        for all
+        """
+        with self.lock:
+            if url is None:
+                self.chunks.clear()
+                self.nbytes = 0
+                return
+            for key in [_ for _ in self.chunks if _[0] == url]:
+                self.nbytes -= self.chunks.pop(key).nbytes
 
 
-class Info:
-    """information on the precomputed data source"""
+#
+# The decoded chunks shared by all read_chunk calls in the process. Chunks
+# are not checked against their source, so the cache is off unless the
+# PRECOMPUTED_TIF_CACHE_BYTES environment variable or set_cache_bytes
+# gives it a size.
+#
+CHUNK_CACHE = ChunkCache(
+    int(os.environ.get("PRECOMPUTED_TIF_CACHE_BYTES", 0)))
+
+
+def set_max_workers(max_workers):
+    """Set the number of threads in the shared chunk fetching pool
+
+    :param max_workers: the maximum number of chunks fetched concurrently
+    """
+    global EXECUTOR, MAX_WORKERS
+    old_executor = EXECUTOR
+    MAX_WORKERS = max_workers
+    EXECUTOR = ThreadPoolExecutor(max_workers=max_workers)
+    old_executor.shutdown(wait=False)
+
+
+def set_cache_bytes(max_bytes):
+    """Set the size limit of the shared chunk cache
+
+    :param max_bytes: the maximum number of bytes of decoded chunks to keep.
+    Zero disables the cache.
+    """
+    with CHUNK_CACHE.lock:
+        CHUNK_CACHE.max_bytes = max_bytes
+        while CHUNK_CACHE.nbytes > max_bytes:
+            _, old_chunk = CHUNK_CACHE.chunks.popitem(last=False)
+            CHUNK_CACHE.nbytes -= old_chunk.nbytes
+
+
+def _after_fork_in_child():
+    """Replace the shared state whose threads and sockets do not survive fork"""
+    global EXECUTOR, SOURCE_EXECUTOR, SESSION
+    EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    SOURCE_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    SESSION = make_session()
+    CHUNK_CACHE.lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
-    TYPE_INFO = "info"
-    TYPE_SEGMENTATION = "segmentation"
+
+class Scale:
+    """Represents a mipmap level on the precomputed data source
+
+    The fields are read once, here, since they are looked up for every
+    chunk that is read.
+
+    chunk_sizes: the dimensions of one chunk
+    encoding: the chunk encoding, e.g. "raw"
+    key: the key for data retrieval
+    shape: the voxel dimensions (the "size" field)
+    offset: the offset of the dataset in the larger space in voxels
+    """
 
     def __init__(self, d):
         self.d = d
+        self.chunk_sizes = d["chunk_sizes"][0]
+        self.encoding = d.get("encoding")
+        self.key = d["key"]
+        self.shape = d["size"]
+        self.offset = d.get("voxel_offset", [0, 0, 0])
 
-    @property
-    def data_type(self):
-        """The data type of the data source, e.g. np.uint16"""
-        return np.dtype(self.d["data_type"])
 
-    @property
-    def type(self):
-        """The type of the voxel data
+class Info:
+    """information on the precomputed data source
 
-        One of "image", or "segmentation"
-        """
-        return self.d["type"]
+    data_type: the data type of the data source, e.g. np.uint16
+    type: the type of the voxel data, "image" or "segmentation"
+    """
+
+    TYPE_INFO = "info"
+    TYPE_SEGMENTATION = "segmentation"
+
+    def __init__(self, d):
+        self.d = d
+        self.data_type = np.dtype(d["data_type"])
+        self.type = d.get("type")
+        self.scales = dict((scale["key"], Scale(scale))
+                           for scale in d["scales"])
 
     def get_scale(self, level) -> Scale:
         """Get the Scale object for the given level
@@ -80,10 +214,9 @@ class Info:
         else:
             level = tuple(level)
         key = "_".join([str(_) for _ in level])
-        for scale in self.d["scales"]:
-            if scale["key"] == key:
-                return Scale(scale)
-        else:
+        try:
+            return self.scales[key]
+        except KeyError:
             raise KeyError("No such level: %s" % str(level))
 
 
@@ -98,15 +231,27 @@ def get_info(url) -> Info:
         url = url[len(precomputed):]
     if url in __cache:
         return __cache[url]
-    info_url = url + "/info"
-    if info_url.startswith('http') or info_url.startswith('https'):
-    	content=requests.get(info_url).text
-    else:
-    	content= urlopen(info_url).read().decode("ascii") 
-    __cache[url] = Info(json.loads(content))
+    __cache[url] = Info(json.loads(read_url(url + "/info")))
     return __cache[url]
 
 
+def read_url(url):
+    """Read the contents of a URL
+
+    http(s) URLs are fetched with the shared SESSION so that they reuse its
+    kept-alive connections.
+
+    :param url: the URL to read
+    :return: the contents as bytes
+    """
+    if url.startswith('http'):
+        response = SESSION.get(url)
+        response.raise_for_status()
+        return response.content
+    with urlopen(url) as fd:
+        return fd.read()
+
+
 def get_ngff_info(url) -> Info:
     if url in __cache:
         return __cache[url]
@@ -134,7 +279,7 @@ def get_ngff_info(url) -> Info:
 
 
 def clear_cache(url=None):
-    """Clear the cache of info files
+    """Clear the cache of info files and chunks
 
     :param url: url to clear or None (default) for all
     """
@@ -142,23 +287,44 @@ def clear_cache(url=None):
         __cache.clear()
     elif url in __cache:
         del __cache[url]
+    CHUNK_CACHE.clear(url)
 
 
 def _chunk_start(coord, offset, stride):
-    if coord < offset:
-        return offset
-    modulo = (coord - offset) % stride
-    return coord - modulo
+    coord = max(coord, offset)
+    return coord - (coord - offset) % stride
 
 
 def _chunk_end(coord, offset, stride, end):
-    result = _chunk_start(coord, offset, stride) + stride
-    if result > end:
-        return end
-    return result
+    return min(end, _chunk_start(coord, offset, stride) + stride)
+
 
+def _chunk_grid(c0, c1, offset, stride, end):
+    """The chunks along one axis that overlap a range of coordinates
 
-def read_chunk(url, x0, x1, y0, y1, z0, z1, level=1, format="tiff"):
+    :param c0: the start of the requested range
+    :param c1: the end of the requested range (non-inclusive)
+    :param offset: the offset of the first chunk
+    :param stride: the chunk size along the axis
+    :param end: the end of the data source along the axis
+    :return: a list of tuples of the chunk's start and end, the start and
+    end of the overlap within the chunk and the start and end of the
+    overlap within the requested range.
+    """
+    starts = np.arange(_chunk_start(c0, offset, stride),
+                       _chunk_end(c1 - 1, offset, stride, end),
+                       stride)
+    ends = np.minimum(starts + stride, end)
+    a0 = np.maximum(starts, c0)
+    a1 = np.minimum(ends, c1)
+    overlaps = a1 > a0
+    return list(zip(*[_[overlaps].tolist() for _ in
+                      (starts, ends, a0 - starts, a1 - starts,
+                       a0 - c0, a1 - c0)]))
+
+
+def read_chunk(url, x0, x1, y0, y1, z0, z1, level=1, format="tiff",
+               max_workers=None, session=None):
     """Read an arbitrary chunk of data
 
     :param url: Base URL of the precomputed data source
@@ -171,93 +337,142 @@ def read_chunk(url, x0, x1, y0, y1, z0, z1, level=1, format="tiff"):
     :param level: mipmap level
     :param format: the read format if it's a file URL. Defaults to tiff, but
     you can use "blockfs"
+    :param max_workers: the maximum number of chunks to fetch concurrently.
+    Defaults to using the shared pool (see set_max_workers).
+    :param session: the requests.Session for http(s) fetches. Defaults to
+    the module's shared SESSION.
     :return: a Numpy array containing the data
     """
     is_file = urlparse(url).scheme.lower() == "file"
     info = get_info(url)
     scale = info.get_scale(level)
-    result = np.zeros((z1-z0, y1-y0, x1-x0), info.data_type)
     shape = np.array(scale.shape)
     offset = np.array(scale.offset)
     stride = np.array(scale.chunk_sizes)
     end = offset + shape
 
-    x0d = _chunk_start(x0, offset[0], stride[0])
-    x1d = _chunk_end(x1, offset[0], stride[0], end[0])
-    y0d = _chunk_start(y0, offset[1], stride[1])
-    y1d = _chunk_end(y1, offset[1], stride[1], end[1])
-    z0d = _chunk_start(z0, offset[2], stride[2])
-    z1d = _chunk_end(z1, offset[2], stride[2], end[2])
-    for x0c, y0c, z0c in itertools.product(
-        range(x0d, x1d, stride[0]),
-        range(y0d, y1d, stride[1]),
-        range(z0d, z1d, stride[2])):
-        x1c = min(x1d, x0c + stride[0])
-        y1c = min(y1d, y0c + stride[1])
-        z1c = min(z1d, z0c + stride[2])
-        chunk_url = url + "/" + scale.key + "/%d-%d_%d-%d_%d-%d" % (
-            x0c, x1c, y0c, y1c, z0c, z1c)
+    if is_file:
+        level_parse = urlparse(url + "/" + scale.key)
+        level_path = os.path.join(level_parse.netloc,
+                                  unquote(level_parse.path))
+    if is_file and format == "blockfs":
+        from blockfs import Directory
+        from .blockfs_stack import BlockfsStack
+        directory_url = url + "/" + scale.key + "/" +\
+                        BlockfsStack.DIRECTORY_FILENAME
+        directory_parse = urlparse(directory_url)
+        directory_path = os.path.join(
+            directory_parse.netloc,
+            unquote(directory_parse.path))
+        directory = Directory.open(directory_path)
+    elif is_file and format == "ngff":
+        group = get_ngff_group_from_url(url)
+        dataset = group[str(int(np.log2(level)))]
+        dataset.read_only = True
+    elif is_file and format == "zarr":
+        dataset = zarr.Array(zarr.NestedDirectoryStore(level_path),
+                             read_only=True)
+
+    def read_one(grid):
+        (x0c, *_), (y0c, *_), (z0c, *_) = grid
+        key = (url, scale.key, format, x0c, y0c, z0c)
+        chunk = CHUNK_CACHE.get(key)
+        if chunk is None:
+            chunk = fetch_one(grid)
+            CHUNK_CACHE.put(key, chunk)
+        return chunk
+
+    def fetch_one(grid):
+        (x0c, x1c, *_), (y0c, y1c, *_), (z0c, z1c, *_) = grid
+        chunk_name = "%d-%d_%d-%d_%d-%d" % (x0c, x1c, y0c, y1c, z0c, z1c)
         if is_file:
             if format == "tiff":
-                chunk_url += ".tiff"
-                with urlopen(chunk_url) as fd:
-                    chunk = tifffile.imread(fd)
+                return tifffile.imread(
+                    os.path.join(level_path, chunk_name + ".tiff"))
             elif format == "blockfs":
-                from blockfs import Directory
-                from .blockfs_stack import BlockfsStack
-                directory_url = url + "/" + scale.key + "/" +\
-                                BlockfsStack.DIRECTORY_FILENAME
-                directory_parse = urlparse(directory_url)
-                directory_path = os.path.join(
-                    directory_parse.netloc,
-                    unquote(directory_parse.path))
-                directory = Directory.open(directory_path)
-                chunk = directory.read_block(x0c, y0c, z0c)
-            elif format == 'ngff':
-                group = get_ngff_group_from_url(url)
-                key = str(int(np.log2(level)))
-                dataset = group[key]
-                dataset.read_only = True
-                chunk = dataset[0, 0, z0c:z1c, y0c:y1c, x0c:x1c]
-            elif format == 'zarr':
-                zarr_url = url + "/" + scale.key
-                zarr_parse = urlparse(zarr_url)
-                zarr_path = os.path.join(zarr_parse.netloc,
-                                         unquote(zarr_parse.path))
-                storage = zarr.NestedDirectoryStore(zarr_path)
-                dataset = zarr.Array(storage)
-                chunk = dataset[z0c:z1c, y0c:y1c, x0c:x1c]
+                return directory.read_block(x0c, y0c, z0c)
             else:
                 raise NotImplementedError("Can't read %s yet" % format)
+        chunk_url = url + "/" + scale.key + "/" + chunk_name
+        if chunk_url.startswith("http"):
+            response = (session or SESSION).get(chunk_url)
+            response.raise_for_status()
+            data = response.content
         else:
-            response = urlopen(chunk_url)
-            data = response.read()
-            chunk = np.frombuffer(data, info.data_type).reshape(
-                    (z1c - z0c, y1c - y0c, x1c - x0c))
-        if z0c < z0:
-            chunk = chunk[z0 - z0c:]
-            z0c = z0
-        if z1c > z1:
-            chunk = chunk[:z1-z0c]
-            z1c = z1
-        if y0c < y0:
-            chunk = chunk[:, y0 - y0c:]
-            y0c = y0
-        if y1c > y1:
-            chunk = chunk[:, :y1-y0c]
-            y1c = y1
-        if x0c < x0:
-            chunk = chunk[:, :, x0 - x0c:]
-            x0c = x0
-        if x1c > x1:
-            chunk = chunk[:, :, :x1-x0c]
-            x1c = x1
-        result[z0c - z0:z0c - z0 + chunk.shape[0],
-               y0c - y0:y0c - y0 + chunk.shape[1],
-               x0c - x0:x0c - x0 + chunk.shape[2]] = chunk
+            data = urlopen(chunk_url).read()
+        return np.frombuffer(data, info.data_type).reshape(
+                (z1c - z0c, y1c - y0c, x1c - x0c))
+
+    def read_into(grid):
+        #
+        # zarr decompresses straight into the result, so there is no
+        # chunk to cache or paste.
+        #
+        ((x0c, _, sx0, sx1, dx0, dx1),
+         (y0c, _, sy0, sy1, dy0, dy1),
+         (z0c, _, sz0, sz1, dz0, dz1)) = grid
+        selection = (slice(z0c + sz0, z0c + sz1),
+                     slice(y0c + sy0, y0c + sy1),
+                     slice(x0c + sx0, x0c + sx1))
+        if format == "ngff":
+            selection = (0, 0) + selection
+        dataset.get_basic_selection(
+            selection, out=result[dz0:dz1, dy0:dy1, dx0:dx1])
+
+    tasks = list(itertools.product(
+        _chunk_grid(x0, x1, offset[0], stride[0], end[0]),
+        _chunk_grid(y0, y1, offset[1], stride[1], end[1]),
+        _chunk_grid(z0, z1, offset[2], stride[2], end[2])))
+    read_zarr = is_file and format in ("ngff", "zarr")
+    if not read_zarr and len(tasks) == 1 and \
+            all(dst0 == 0 and dst1 == extent for (*_, dst0, dst1), extent in
+                zip(tasks[0], (x1 - x0, y1 - y0, z1 - z0))):
+        #
+        # The ROI lies inside a single chunk: slice it rather than pasting
+        # it into a zero-filled result. Cached chunks are read-only, so
+        # those are copied to keep the result writable.
+        #
+        ((_, _, sx0, sx1, _, _),
+         (_, _, sy0, sy1, _, _),
+         (_, _, sz0, sz1, _, _)) = tasks[0]
+        chunk = read_one(tasks[0])[sz0:sz1, sy0:sy1, sx0:sx1]
+        return chunk if chunk.flags.writeable else chunk.copy()
+    result = np.zeros((z1-z0, y1-y0, x1-x0), info.data_type)
+    fn = read_into if read_zarr else read_one
+    if max_workers is None:
+        chunks = EXECUTOR.map(fn, tasks)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        chunks = executor.map(fn, tasks)
+        executor.shutdown(wait=False)
+    if read_zarr:
+        for _ in chunks:
+            pass
+        return result
+    for ((_, _, sx0, sx1, dx0, dx1),
+         (_, _, sy0, sy1, dy0, dy1),
+         (_, _, sz0, sz1, dz0, dz1)), chunk in zip(tasks, chunks):
+        result[dz0:dz1, dy0:dy1, dx0:dx1] = \
+            chunk[sz0:sz1, sy0:sy1, sx0:sx1]
     return result
 
 
+async def aread_chunk(url, x0, x1, y0, y1, z0, z1, level=1, format="tiff",
+                      **kwargs):
+    """Read an arbitrary chunk of data without blocking the event loop
+
+    The arguments are the same as for read_chunk, which is run in the
+    event loop's default executor. Its chunk fetches are concurrent and
+    release the GIL while waiting on the network or the disk.
+
+    :return: a Numpy array containing the data
+    """
+    # Inside a coroutine this is the running loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(
+        read_chunk, url, x0, x1, y0, y1, z0, z1, level, format, **kwargs))
+
+
 def get_ngff_group_from_url(url:str) -> zarr.Group:
     """Open the Zarr group from a NGFF file url
     """
@@ -278,58 +493,37 @@ class ArrayReaderBase:
         raise NotImplementedError("Implement shape in your class")
 
     def __getitem__(self, key):
-        def s(idx, axis):
-            if idx is None:
-                return 0
-            if idx < 0:
-                return self.shape[axis] + idx
-            return idx
-
-        def e(idx, axis):
-            if idx is None:
-                return self.shape[axis]
-            if idx < 0:
-                return self.shape[axis] + idx
-            return idx
-
         assert len(key) == 3, "Please specify 3 axes when indexing"
-        if isinstance(key[0], slice):
-            z0 = s(key[0].start, 0)
-            z1 = e(key[0].stop, 0)
-            zs = key[0].step
-            zsquish=False
-        else:
-            z0 = s(key[0], 0)
-            z1 = z0 + 1
-            zsquish=True
-            zs = 1
-        if isinstance(key[1], slice):
-            y0 = s(key[1].start, 1)
-            y1 = e(key[1].stop, 1)
-            ys = key[1].step
-            ysquish=False
-        else:
-            y0 = s(key[1], 1)
-            y1 = y0 + 1
-            ysquish=True
-            ys = 1
-        if isinstance(key[2], slice):
-            x0 = s(key[2].start, 2)
-            x1 = e(key[2].stop, 2)
-            xs = key[2].step
-            xsquish=False
-        else:
-            x0 = s(key[2], 2)
-            x1 = x0 + 1
-            xsquish=True
-            xs = 1
+        #
+        # self.shape can be costly (DANDIArrayReader), so fetch it once
+        #
+        shape = self.shape
+        starts, stops, steps, squished = [], [], [], []
+        for extent, idx in zip(shape, key):
+            if isinstance(idx, slice):
+                start, stop = idx.start, idx.stop
+                if start is None:
+                    start = 0
+                elif start < 0:
+                    start += extent
+                if stop is None:
+                    stop = extent
+                elif stop < 0:
+                    stop += extent
+                starts.append(start)
+                stops.append(stop)
+                steps.append(idx.step)
+            else:
+                start = idx + extent if idx < 0 else idx
+                starts.append(start)
+                stops.append(start + 1)
+                steps.append(1)
+                squished.append(len(starts) - 1)
+        (z0, y0, x0), (z1, y1, x1), (zs, ys, xs) = starts, stops, steps
         block = self.read_chunk(x0, x1, y0, y1, z0, z1)[::zs, ::ys, ::xs]
-        if xsquish:
-            block = block[:, :, 0]
-        if ysquish:
-            block = block[:, 0]
-        if zsquish:
-            block = block[0]
+        if squished:
+            block = block[tuple(0 if axis in squished else slice(None)
+                                for axis in range(3))]
         return block
 
     def read_chunk(self, x0, x1, y0, y1, z0, z1):
@@ -337,16 +531,33 @@ class ArrayReaderBase:
 
 
 class ArrayReader(ArrayReaderBase):
-    def __init__(self, url, format='tiff', level=1):
+    def __init__(self, url, format='tiff', level=1, prefetch_depth=4,
+                 session=None):
         """
         Initialize the reader with the precomputed data source URL
         :param url: URL of the data source
         :param format: either 'tiff', 'blockfs' or 'zarr'
         :param level: the mipmap level
+        :param prefetch_depth: when reading a slab thinner than a chunk,
+        read this many slabs below it in the background so that scrolling
+        through Z finds them in the chunk cache. Zero disables prefetching.
+        :param session: the requests.Session for http(s) fetches. Defaults
+        to the session shared by all readers.
         """
         self.url = url
         self.format = format
         self.level = level
+        self.prefetch_depth = prefetch_depth
+        self.session = session
+        self.prefetch_pool = None
+        self.prefetch_pid = None
+        self.prefetch_futures = {}
+        #
+        # Local zarr and NGFF reads decompress straight into the result and
+        # do not go through the chunk cache, so there is nothing to prefetch
+        #
+        self.bypasses_cache = urlparse(url).scheme.lower() == "file" and \
+            format in ("ngff", "zarr")
         try:
             self.info = get_info(url)
         except:
@@ -365,9 +576,50 @@ class ArrayReader(ArrayReaderBase):
         return self.info.data_type
 
     def read_chunk(self, x0, x1, y0, y1, z0, z1):
-        return read_chunk(self.url, x0, x1, y0, y1, z0, z1,
-                          self.level, self.format)
+        result = read_chunk(self.url, x0, x1, y0, y1, z0, z1,
+                            self.level, self.format, session=self.session)
+        if self.prefetch_depth > 0 and CHUNK_CACHE.max_bytes > 0 and \
+                not self.bypasses_cache and \
+                z1 - z0 < self.scale.chunk_sizes[2]:
+            self.prefetch(x0, x1, y0, y1, z0, z1)
+        return result
 
+    def prefetch(self, x0, x1, y0, y1, z0, z1):
+        """Start reading the slabs below the given one into the chunk cache
+
+        Pending reads of slabs that are no longer ahead of this one are
+        cancelled.
+        """
+        z_end = self.scale.offset[2] + self.scale.shape[2]
+        depth = z1 - z0
+        windows = []
+        for k in range(1, self.prefetch_depth + 1):
+            pz0 = z0 + k * depth
+            pz1 = min(pz0 + depth, z_end)
+            if pz0 >= pz1:
+                break
+            windows.append((x0, x1, y0, y1, pz0, pz1))
+        for window in list(self.prefetch_futures):
+            if window not in windows:
+                self.prefetch_futures.pop(window).cancel()
+        if self.prefetch_pid != os.getpid():
+            # The pool's threads do not survive a fork
+            self.prefetch_pool = ThreadPoolExecutor(
+                max_workers=self.prefetch_depth)
+            self.prefetch_pid = os.getpid()
+            self.prefetch_futures = {}
+        for window in windows:
+            if window not in self.prefetch_futures:
+                self.prefetch_futures[window] = self.prefetch_pool.submit(
+                    read_chunk, self.url, *window, self.level, self.format,
+                    session=self.session)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["prefetch_pool"] = None
+        state["prefetch_pid"] = None
+        state["prefetch_futures"] = {}
+        return state
 
 
 class DANDIArrayReader(ArrayReaderBase):
@@ -404,20 +656,24 @@ class DANDIArrayReader(ArrayReaderBase):
                 self.offsets.append((zoff, yoff, xoff))
             else:
                 xform_url = url[:-9] + "transforms.json"
-                with urlopen(xform_url) as fd:
-                    xform = json.load(fd)
+                xform = json.loads(read_url(xform_url))
                 self.offsets.append(
                     tuple(int(xform[0]["TransformationParameters"][_]) // level
                           for _ in ("ZOffset", "YOffset", "XOffset")))
+        #
+        # The start and end of each source in Z, Y, X order, one row per
+        # source, so that overlap tests can be done on all sources at once
+        #
+        self.starts = np.array(self.offsets, np.int64).reshape(-1, 3)
+        self.ends = self.starts + np.array(
+            [ar.shape for ar in self.array_readers], np.int64).reshape(-1, 3)
 
     def load_sidecar(self, url):
         if url.endswith(".ngff"):
             sidecar_url = url[:-4] + "json"
         elif url.endswith(".ome.zarr"):
             sidecar_url = url[:-8] + "json"
-        with urlopen(sidecar_url) as fd:
-            sidecar = json.load(fd)
-        return sidecar
+        return json.loads(read_url(sidecar_url))
 
     def get_info(self):
         sidecar = self.load_sidecar(self.urls[0])
@@ -458,36 +714,68 @@ class DANDIArrayReader(ArrayReaderBase):
 
         
     def x0(self, idx):
-        return self.offsets[idx][2]
+        return int(self.starts[idx, 2])
 
     def x1(self, idx):
-        return self.x0(idx) + self.array_readers[idx].shape[2]
+        return int(self.ends[idx, 2])
 
     def y0(self, idx):
-        return self.offsets[idx][1]
+        return int(self.starts[idx, 1])
 
     def y1(self, idx):
-        return self.y0(idx) + self.array_readers[idx].shape[1]
+        return int(self.ends[idx, 1])
 
     def z0(self, idx):
-        return self.offsets[idx][0]
+        return int(self.starts[idx, 0])
 
     def z1(self, idx):
-        return self.z0(idx) + self.array_readers[idx].shape[0]
+        return int(self.ends[idx, 0])
 
     @property
     def shape(self):
-        return tuple(np.max([fn(_) for _ in range(len(self.urls))])
-                     for fn in (self.z1, self.y1, self.x1))
+        return tuple(int(_) for _ in self.ends.max(axis=0))
 
     @property
     def dtype(self):
         return self.array_readers[0].dtype
 
 
+    def overlaps(self,
+                 idx:int,
+                 x0:int, x1:int, y0:int, y1:int, z0:int, z1:int) -> bool:
+        """
+        Determine whether a chunk has data in a range
+        :param idx: the index of the chunk in question
+        :param x0: The start x in global coordinates
+        :param x1: The end x in global coordinates
+        :param y0: The start y in global coordinates
+        :param y1: The end y in global coordinates
+        :param z0: The start z in global coordinates
+        :param z1: The end z in global coordinates
+        """
+        return bool(np.all((self.starts[idx] < (z1, y1, x1)) &
+                           (self.ends[idx] > (z0, y0, x0))))
+
+    def overlapping(self,
+                    x0:int, x1:int, y0:int, y1:int, z0:int, z1:int) -> list:
+        """
+        Find the chunks that have data in a range
+        :param x0: The start x in global coordinates
+        :param x1: The end x in global coordinates
+        :param y0: The start y in global coordinates
+        :param y1: The end y in global coordinates
+        :param z0: The start z in global coordinates
+        :param z1: The end z in global coordinates
+        :return: the indices of the chunks, in order
+        """
+        mask = np.all((self.starts < (z1, y1, x1)) &
+                      (self.ends > (z0, y0, x0)), axis=1)
+        return np.flatnonzero(mask).tolist()
+
     def get(self,
             idx:int,
-            x0:int, x1:int, y0:int, y1:int, z0:int, z1:int):
+            x0:int, x1:int, y0:int, y1:int, z0:int, z1:int,
+            out:np.ndarray=None):
         """
         Get a data range from a chunk.
         :param idx: the index of the chunk in question
@@ -497,11 +785,15 @@ class DANDIArrayReader(ArrayReaderBase):
         :param y1: The end y in global coordinates
         :param z0: The start z in global coordinates
         :param z1: The end z in global coordinates
+        :param out: if present, a zero-filled array to hold the data read
         :return: a two-tuple of an array containing the data read and
                  an array similarly sized to data, giving the manhattan
                  distance to the nearest edge.
         """
-        data = np.zeros((z1-z0, y1-y0, x1-x0), self.dtype)
+        if out is None:
+            data = np.zeros((z1-z0, y1-y0, x1-x0), self.dtype)
+        else:
+            data = out
         ar = self.array_readers[idx]
         x0c = self.x0(idx)
         y0c = self.y0(idx)
@@ -509,10 +801,8 @@ class DANDIArrayReader(ArrayReaderBase):
         x1c = self.x1(idx)
         y1c = self.y1(idx)
         z1c = self.z1(idx)
-        if x0c >= x1 or x0 >= x1c or \
-           y0c >= y1 or y0 >= y1c or \
-           z0c >= z1 or z0 >= z1c:
-           return
+        if not self.overlaps(idx, x0, x1, y0, y1, z0, z1):
+            return
 
         x0a = max(x0c, x0)
         x1a = min(x1c, x1)
@@ -521,22 +811,42 @@ class DANDIArrayReader(ArrayReaderBase):
         z0a = max(z0c, z0)
         z1a = min(z1c, z1)
         chunk = ar[z0a-z0c:z1a-z0c, y0a-y0c:y1a-y0c, x0a-x0c:x1a - x0c]
-        data[z0a-z0:z1a-z0, y0a-y0:y1a-y0, x0a-x0:x1a-x0] += chunk
-        nx = np.arange(x0-x0c, x1-x0c)
-        fx = np.arange(x1c-x0-1, x1c-x1-1, -1)
-        ny = np.arange(y0-y0c, y1-y0c)
-        fy = np.arange(y1c-y0-1, y1c-y1-1, -1)
-        nz = np.arange(z0-z0c, z1-z0c)
-        fz = np.arange(z1c-z0-1, z1c-z1-1, -1)
-        xd = np.minimum(nx.reshape(1, 1, -1), fx.reshape(1, 1, -1))
-        yd = np.minimum(ny.reshape(1, -1, 1), fy.reshape(1, -1, 1))
-        zd = np.minimum(nz.reshape(-1, 1, 1), fz.reshape(-1, 1, 1))
+        data[z0a-z0:z1a-z0, y0a-y0:y1a-y0, x0a-x0:x1a-x0] = chunk
+        #
+        # The per-axis distances are 1-d. Only the final broadcast
+        # minimum is the size of the block, and it is int32 to match
+        # the distance accumulators in read_chunk.
+        #
+        nx = np.arange(x0-x0c, x1-x0c, dtype=np.int32)
+        fx = np.arange(x1c-x0-1, x1c-x1-1, -1, dtype=np.int32)
+        ny = np.arange(y0-y0c, y1-y0c, dtype=np.int32)
+        fy = np.arange(y1c-y0-1, y1c-y1-1, -1, dtype=np.int32)
+        nz = np.arange(z0-z0c, z1-z0c, dtype=np.int32)
+        fz = np.arange(z1c-z0-1, z1c-z1-1, -1, dtype=np.int32)
+        xd = np.minimum(nx, fx).reshape(1, 1, -1)
+        yd = np.minimum(ny, fy).reshape(1, -1, 1)
+        zd = np.minimum(nz, fz).reshape(-1, 1, 1)
         return data, np.minimum(xd, np.minimum(yd, zd))
 
 
-    def read_chunk(self, x0, x1, y0, y1, z0, z1):
-        datas = []
-        distances = []
+    def read_chunk(self, x0, x1, y0, y1, z0, z1, out=None):
+        """
+        Read a blended range of the volume
+        :param x0: The start x in global coordinates
+        :param x1: The end x in global coordinates
+        :param y0: The start y in global coordinates
+        :param y1: The end y in global coordinates
+        :param z0: The start z in global coordinates
+        :param z1: The end z in global coordinates
+        :param out: if present, an array of shape (z1-z0, y1-y0, x1-x0) to
+        hold the result, e.g. a view of a reused buffer
+        :return: the result array
+        """
+        if out is None:
+            result = np.zeros((z1-z0, y1-y0, x1-x0), self.dtype)
+        else:
+            result = out
+            result[:] = 0
         #
         # We do cosine blending between the two pixels furthest away
         # from their edges. The furthest from the edge is "a" and the
@@ -546,14 +856,22 @@ class DANDIArrayReader(ArrayReaderBase):
         ad = -np.ones_like(a, dtype=np.int32)
         b = np.zeros_like(a)
         bd = -np.ones_like(a, dtype=np.int32)
-        i = 0
-        for idx in range(len(self.urls)):
-            result = self.get(idx, x0, x1, y0, y1, z0, z1)
-            if result is None:
-                continue
-            data, distance = result
-            datas.append(data)
-            distances.append(distance)
+        idxs = self.overlapping(x0, x1, y0, y1, z0, z1)
+        if len(idxs) == 0:
+            return result
+        datas = np.zeros((len(idxs), z1-z0, y1-y0, x1-x0), self.dtype)
+        #
+        # Each volume reads into its own plane of datas, so they can be
+        # read at once. The blend bookkeeping below stays in order.
+        #
+        def get_one(i):
+            return self.get(idxs[i], x0, x1, y0, y1, z0, z1, out=datas[i])[1]
+
+        if len(idxs) == 1:
+            distances = [get_one(0)]
+        else:
+            distances = SOURCE_EXECUTOR.map(get_one, range(len(idxs)))
+        for i, distance in enumerate(distances):
             a_mask = distance >= np.maximum(0, ad)
             b[a_mask]  = a[a_mask]
             bd[a_mask] = ad[a_mask]
@@ -562,26 +880,36 @@ class DANDIArrayReader(ArrayReaderBase):
             b_mask = (~ a_mask) & (distance >= np.maximum(0, bd))
             b[b_mask] = i
             bd[b_mask] = distance[b_mask]
-            i += 1
-        if i == 0:
-            return np.zeros((z1-z0, y1-y0, x1-x0), self.dtype)
-        datas = np.stack(datas)
-        distances = np.stack(distances)
-        double_z, double_y, double_x = np.where(bd >= 0)
-        single_z, single_y, single_x = np.where((ad >= 0) & (bd < 0))
-        result = np.zeros_like(a, dtype=self.dtype)
-        result[single_z, single_y, single_x] = \
-            datas[a[single_z, single_y, single_x], single_z, single_y, single_x]
-        if len(double_z) > 0:
-            a_idx = a[double_z, double_y, double_x]
-            distances_a = distances[a_idx, double_z, double_y, double_x]
-            b_idx = b[double_z, double_y, double_x]
-            distances_b = distances[b_idx, double_z, double_y, double_x]
-            datas_a = datas[a_idx, double_z, double_y, double_x]
-            datas_b = datas[b_idx, double_z, double_y, double_x]
-            angle = np.arctan2(distances_a, distances_b)
-            result[double_z, double_y, double_x] = \
-                np.sin(angle) ** 2 * datas_a + np.cos(angle) ** 2 * datas_b
+        datas_a = np.take_along_axis(datas, a[np.newaxis], axis=0)[0]
+        single = (ad >= 0) & (bd < 0)
+        result[single] = datas_a[single]
+        double = bd >= 0
+        if np.any(double):
+            datas_b = np.take_along_axis(datas, b[np.newaxis], axis=0)[0]
+            #
+            # sin(arctan2(a, b)) ** 2 == a ** 2 / (a ** 2 + b ** 2), so for
+            # integer data of up to 32 bits the blend is a ratio of int64s
+            # and can be floored exactly. Floats keep their fraction and
+            # 64-bit integers would overflow, so those are blended in
+            # float64. Where both distances are zero, arctan2 gives 0:
+            # all "b".
+            #
+            da2 = np.square(ad[double], dtype=np.int64)
+            db2 = np.square(bd[double], dtype=np.int64)
+            denominator = da2 + db2
+            zero = denominator == 0
+            denominator[zero] = 1
+            dtype = np.dtype(self.dtype)
+            if dtype.kind in "iu" and dtype.itemsize <= 4:
+                numerator = da2 * datas_a[double] + db2 * datas_b[double]
+                numerator[zero] = datas_b[double][zero]
+                result[double] = numerator // denominator
+            else:
+                numerator = \
+                    da2 * datas_a[double].astype(np.float64) + \
+                    db2 * datas_b[double].astype(np.float64)
+                numerator[zero] = datas_b[double][zero]
+                result[double] = numerator / denominator
         return result
 
 
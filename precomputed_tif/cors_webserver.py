@@ -26,8 +26,10 @@ can connect to the web server.
 from __future__ import print_function, absolute_import
 
 import argparse
+import gzip
 from blockfs.directory import Directory
 import os
+import socket
 import sys
 import io
 import zarr
@@ -42,27 +44,121 @@ FORMAT_NGFF = "ngff"
 
 args = None
 
+#
+# Chunks smaller than this are sent uncompressed even with --gzip
+#
+MIN_GZIP_BYTES = 4096
+
+#
+# Open blockfs directories, keyed by path, with the modification time of
+# the directory file when it was opened.
+#
+DIRECTORIES = {}
+
+
+def open_directory(path):
+    """Open a blockfs directory, reusing it across requests
+
+    :param path: the path to the directory file
+    :return: the blockfs Directory
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = DIRECTORIES.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = DIRECTORIES[path] = (mtime, Directory.open(path))
+    return cached[1]
+
 try:
     # Python3 and Python2 with future package.
     from http.server import SimpleHTTPRequestHandler, HTTPServer, HTTPStatus
+    from socketserver import ThreadingMixIn
 except ImportError:
     from BaseHTTPServer import HTTPServer, HTTPStatus
     from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+def read_zarr_chunk(z_arr, x0, y0, z0):
+    """Read the zarr chunk that starts at the given coordinates
+
+    If the coordinates are on the array's chunk grid, the stored chunk is
+    decompressed straight into a new buffer, bypassing zarr's selection
+    machinery. Otherwise the chunk is read with a slice.
+
+    :param z_arr: the zarr array for the level
+    :param x0: the X coordinate of the chunk's start
+    :param y0: the Y coordinate of the chunk's start
+    :param z0: the Z coordinate of the chunk's start
+    :return: a Numpy array of the voxels in the chunk, clipped to the
+    array's extent
+    """
+    cz, cy, cx = z_arr.chunks
+    z1, y1, x1 = [min(e, a0 + c) for e, a0, c in
+                  zip(z_arr.shape, (z0, y0, x0), (cz, cy, cx))]
+    if z0 % cz == 0 and y0 % cy == 0 and x0 % cx == 0 and \
+            z_arr.order == "C" and not z_arr.filters:
+        try:
+            key = z_arr._chunk_key((z0 // cz, y0 // cy, x0 // cx))
+            raw = z_arr.store[key]
+        except KeyError:
+            # Never written: zarr fills it in below
+            raw = None
+        if raw is not None:
+            out = np.empty(z_arr.chunks, z_arr.dtype)
+            if z_arr.compressor is None:
+                out.reshape(-1).view(np.uint8)[:] = \
+                    np.frombuffer(raw, np.uint8)
+            else:
+                z_arr.compressor.decode(raw, out=out)
+            return out[:z1 - z0, :y1 - y0, :x1 - x0]
+    return z_arr[z0:z1, y0:y1, x0:x1]
 
 
 class RequestHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
+        # Hold the headers back until the body is queued behind them so
+        # that small responses go out in one segment.
+        self.cork(True)
+        try:
+            self.handle_get()
+        finally:
+            self.cork(False)
+
+    def cork(self, on):
+        """Turn TCP_CORK on or off for the connection, if the OS has it
+
+        :param on: True to queue partial segments, False to flush them
+        """
+        if hasattr(socket, "TCP_CORK"):
+            try:
+                self.connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_CORK, int(on))
+            except OSError:
+                # Not a TCP socket
+                pass
+
+    def handle_get(self):
         if args.format == FORMAT_RAW or self.path.startswith("/socket"):
             print("Handing request to simple http request handler")
             super(RequestHandler, self).do_GET()
         elif self.path.find("/info") >= 0:
-            size = pathlib.Path("info").stat().st_size
+            stat = pathlib.Path("info").stat()
+            size = stat.st_size
+            # The info file's mtime and size change whenever it does, so
+            # they make an ETag without reading it.
+            etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
             self.send_response(HTTPStatus.OK)
             self.send_header("Content-type", 'application/octet-stream')
             self.send_header("Content-Length", str(size))
+            self.send_header("ETag", etag)
             self.end_headers()
             with open("info", "rb") as fd:
-                self.copyfile(fd, self.wfile)
+                self.sendfile(fd, size)
 
         elif args.format == FORMAT_TIFF:
             import tifffile
@@ -71,7 +167,26 @@ class RequestHandler(SimpleHTTPRequestHandler):
             if not os.path.exists(path):
                 super(RequestHandler, self).do_GET()
                 return
-            chunk = tifffile.imread(path)
+            with tifffile.TiffFile(path) as tif:
+                series = tif.series[0]
+                offset = series.offset
+                if offset is not None and series.dtype.kind != "b" and \
+                        tif.byteorder == "<" and \
+                        not self.accepts_gzip():
+                    #
+                    # The pixels are stored uncompressed, in order and
+                    # little-endian, as the raw encoding wants, so the
+                    # response is a slice of the file.
+                    #
+                    size = series.size * series.dtype.itemsize
+                    self.send_response(HTTPStatus.OK)
+                    self.send_header("Content-type",
+                                     'application/octet-stream')
+                    self.send_header("Content-Length", str(size))
+                    self.end_headers()
+                    self.sendfile(tif.filehandle, size, offset)
+                    return
+                chunk = tif.asarray()
             self.send_chunk(chunk)
         elif args.format == FORMAT_ZARR:
             import zarr
@@ -82,15 +197,14 @@ class RequestHandler(SimpleHTTPRequestHandler):
             x0, y0, z0 = self.parse_path(path)
             store = zarr.NestedDirectoryStore(level)
             z_arr = zarr.open(store, mode='r')
-            chunk = z_arr[z0:z1, y0:y1, x0:x1]
-            self.send_chunk(chunk)
+            self.send_chunk(read_zarr_chunk(z_arr, x0, y0, z0))
         elif args.format == FORMAT_BLOCKFS:
             level, path = self.path[1:].split('/')
             if not os.path.exists(level):
                 super(RequestHandler, self).do_GET()
                 return
             x0, y0, z0 = self.parse_path(path)
-            directory = Directory.open(
+            directory = open_directory(
                 os.path.join(level, "precomputed.blockfs"))
             chunk = directory.read_block(x0, y0, z0)
             self.send_chunk(chunk)
@@ -112,14 +226,57 @@ class RequestHandler(SimpleHTTPRequestHandler):
         else:
             raise ValueError('Invalid format specified')
 
+    def sendfile(self, fd, size, offset=0):
+        """Send a file's contents to the client
+
+        The bytes go from the page cache to the socket in the kernel if
+        the platform supports it, otherwise they are copied as usual.
+
+        :param fd: the file, opened for binary reading. It need not have
+        a file descriptor, e.g. older tifffile FileHandles.
+        :param size: the number of bytes to send
+        :param offset: the position in the file of the first byte to send
+        """
+        end = offset + size
+        if hasattr(os, "sendfile"):
+            sent = offset
+            try:
+                while sent < end:
+                    n = os.sendfile(self.connection.fileno(), fd.fileno(),
+                                    sent, end - sent)
+                    if n == 0:
+                        break
+                    sent += n
+                return
+            except (OSError, io.UnsupportedOperation, AttributeError):
+                if sent > offset:
+                    raise
+        fd.seek(offset)
+        self.wfile.write(fd.read(size))
+
+    def accepts_gzip(self):
+        """True if the server compresses and the client takes gzip"""
+        return getattr(args, "gzip", False) and \
+            "gzip" in self.headers.get("Accept-Encoding", "")
+
     def send_chunk(self, chunk):
-        byteorder = "C"
-        data = chunk.tostring(byteorder)
+        # The little-endian, C-ordered array's buffer goes to the socket
+        # without copying it into a bytes object first. A big-endian or
+        # non-contiguous chunk is swapped and packed in a single copy.
+        data = memoryview(np.require(
+            chunk, chunk.dtype.newbyteorder("<"), "C")).cast("B")
+        compress = data.nbytes >= MIN_GZIP_BYTES and self.accepts_gzip()
+        if compress:
+            data = memoryview(gzip.compress(data, compresslevel=1))
         self.send_response(HTTPStatus.OK)
         self.send_header("Content-type", 'application/octet-stream')
-        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Length", str(data.nbytes))
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        if getattr(args, "gzip", False):
+            self.send_header("Vary", "Accept-Encoding")
         self.end_headers()
-        self.copyfile(io.BytesIO(data), self.wfile)
+        self.wfile.write(data)
 
     def parse_path(self, path):
         xstr, ystr, zstr = path.split('_')
@@ -133,12 +290,26 @@ class RequestHandler(SimpleHTTPRequestHandler):
         SimpleHTTPRequestHandler.end_headers(self)
 
 
-class Server(HTTPServer):
+class Server(ThreadingMixIn, HTTPServer):
+    """Serve each connection on its own thread
+
+    Neuroglancer fetches many chunks at once, so one slow chunk should not
+    hold up the rest. The port is bound with SO_REUSEPORT where available,
+    so several server processes can share it and the kernel spreads the
+    connections among them.
+    """
     protocol_version = 'HTTP/1.1'
+    daemon_threads = True
 
     def __init__(self, server_address):
         HTTPServer.__init__(self, server_address, RequestHandler)
 
+    def server_bind(self):
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
 
 def main():
     global args
@@ -148,6 +319,9 @@ def main():
     ap.add_argument('-d', '--directory', default='.', help='Directory to serve')
     ap.add_argument('-f', '--format', default=FORMAT_RAW,
                     help="Format of the backend volumes: raw, tiff or zarr")
+    ap.add_argument('--gzip', action='store_true',
+                    help="Compress chunks with gzip for clients that "
+                         "accept it. This trades CPU for bandwidth.")
 
     args = ap.parse_args()
     os.chdir(args.directory)
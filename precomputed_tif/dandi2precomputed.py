@@ -1,20 +1,32 @@
 import argparse
-import itertools
 import logging
 import multiprocessing
+import os
 import pathlib
 import numpy as np
 import sys
+import threading
 import tqdm
 import typing
 
 from .blockfs_stack import BlockfsStack
 from blockfs.directory import Directory
-from .client import DANDIArrayReader
+from .client import DANDIArrayReader, set_cache_bytes
 
 SOURCE:DANDIArrayReader = None
 DIRECTORY:Directory = None
 ORIGIN:typing.Tuple[int, int, int] = (0, 0, 0)
+#
+# Each worker reads its blocks into this buffer rather than allocating
+# a new one per block. write_block is done with it before returning.
+#
+SCRATCH:np.ndarray = None
+#
+# The number of blocks sent to a worker at a time and the number of those
+# batches per core that can be waiting or in progress.
+#
+LEVEL_1_CHUNKSIZE = 16
+IN_FLIGHT_PER_CORE = 4
 
 
 def parse_args(args=sys.argv[1:]):
@@ -44,30 +56,95 @@ def parse_args(args=sys.argv[1:]):
     return parser.parse_args(args)
 
 
+def init_worker(source, directory, origin):
+    """Initialize a write_level_1 worker process
+
+    The reader and directory are handed over once per worker, so they are
+    in place however the pool starts its processes, and each worker keeps
+    them for all of its blocks. Every block is read once, so the client's
+    chunk cache is turned off.
+
+    :param source: the DANDIArrayReader of the volume
+    :param directory: the level 1 blockfs directory. Its writer processes
+    must already have been started in the parent.
+    :param origin: the Z, Y and X offset of the subvolume in the source
+    """
+    global SOURCE, DIRECTORY, ORIGIN, SCRATCH
+    set_cache_bytes(0)
+    SOURCE = source
+    DIRECTORY = directory
+    ORIGIN = origin
+    SCRATCH = np.empty((64, 64, 64), source.dtype)
+
+
 def write_one(x0, y0, z0):
     z1, y1, x1 = [a0 + s for a0, s in
                   zip((z0, y0, x0),DIRECTORY.get_block_size(x0, y0, z0))]
-    block = SOURCE[z0+ORIGIN[0]:z1+ORIGIN[0],
-                   y0+ORIGIN[1]:y1+ORIGIN[1],
-                   x0+ORIGIN[2]:x1+ORIGIN[2]]
+    block = SOURCE.read_chunk(x0+ORIGIN[2], x1+ORIGIN[2],
+                              y0+ORIGIN[1], y1+ORIGIN[1],
+                              z0+ORIGIN[0], z1+ORIGIN[0],
+                              out=SCRATCH[:z1-z0, :y1-y0, :x1-x0])
     DIRECTORY.write_block(block, x0, y0, z0)
 
 
+def write_one_star(coords):
+    write_one(*coords)
+
+
+def tiled_coords(x_extent, y_extent, z_extent, tile):
+    """The origins of the 64-voxel blocks, grouped by source chunk
+
+    Consecutive blocks come from the same tile, so a worker's batch reads
+    the same source chunks rather than a column through the volume.
+
+    :param x_extent: the size of the volume in the X direction
+    :param y_extent: the size of the volume in the Y direction
+    :param z_extent: the size of the volume in the Z direction
+    :param tile: the X, Y and Z size of a source chunk
+    :return: a generator of (x0, y0, z0) block origins
+    """
+    tx, ty, tz = [max(64, (_ + 63) // 64 * 64) for _ in tile]
+    for tz0 in range(0, z_extent, tz):
+        for ty0 in range(0, y_extent, ty):
+            for tx0 in range(0, x_extent, tx):
+                for z0 in range(tz0, min(tz0 + tz, z_extent), 64):
+                    for y0 in range(ty0, min(ty0 + ty, y_extent), 64):
+                        for x0 in range(tx0, min(tx0 + tx, x_extent), 64):
+                            yield x0, y0, z0
+
+
 def write_level_1(args, stack:BlockfsStack):
     global DIRECTORY
     DIRECTORY = stack.make_l1_directory(args.n_cores)
     DIRECTORY.create()
     DIRECTORY.start_writer_processes()
-    x0s = np.arange(0, stack.x_extent, 64)
-    y0s = np.arange(0, stack.y_extent, 64)
-    z0s = np.arange(0, stack.z_extent, 64)
-    with multiprocessing.Pool(args.n_cores) as pool:
-        futures = []
-        for x0, y0, z0 in itertools.product(x0s, y0s, z0s):
-            futures.append(pool.apply_async(
-                write_one, (x0, y0, z0)))
-        for future in tqdm.tqdm(futures):
-            future.get()
+    n_blocks = np.prod([(_ + 63) // 64 for _ in
+                        (stack.x_extent, stack.y_extent, stack.z_extent)])
+    n_cores = args.n_cores or os.cpu_count()
+    #
+    # The pool's task handler drains its input as fast as it can, so the
+    # coordinates are handed out through a semaphore that only lets
+    # IN_FLIGHT_PER_CORE batches per core be outstanding. Memory stays flat
+    # however large the volume.
+    #
+    in_flight = threading.Semaphore(
+        n_cores * IN_FLIGHT_PER_CORE * LEVEL_1_CHUNKSIZE)
+
+    def throttled():
+        for coords in tiled_coords(stack.x_extent, stack.y_extent,
+                                   stack.z_extent,
+                                   SOURCE.array_readers[0].scale.chunk_sizes):
+            in_flight.acquire()
+            yield coords
+
+    with multiprocessing.Pool(args.n_cores,
+                              initializer=init_worker,
+                              initargs=(SOURCE, DIRECTORY, ORIGIN)) as pool:
+        for _ in tqdm.tqdm(
+                pool.imap_unordered(write_one_star, throttled(),
+                                    chunksize=LEVEL_1_CHUNKSIZE),
+                total=n_blocks):
+            in_flight.release()
         DIRECTORY.close()
 
 
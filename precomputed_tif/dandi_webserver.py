@@ -31,12 +31,97 @@ def application(environ, start_response):
 
 """
 
+import functools
+import hashlib
 import json
+import numpy as np
+import os
+import re
+from operator import itemgetter
+import threading
+import time
 import urllib
 from urllib.parse import quote
 
 from .client import DANDIArrayReader
 
+#
+# The parsed config file, its sources by name and its rendered listing page
+# (None until the page is first asked for), keyed by path, with the
+# modification time it was read at so that edits are picked up without
+# restarting the server.
+#
+CONFIG_CACHE = {}
+CONFIG_CACHE_LOCK = threading.Lock()
+
+#
+# The serialized info for a source, keyed by its tuple of URLs, with its
+# ETag and the time it was made. Entries are rebuilt after INFO_CACHE_TTL seconds.
+#
+INFO_CACHE = {}
+INFO_CACHE_LOCK = threading.Lock()
+INFO_CACHE_TTL = 600
+
+#
+# The most bytes of a chunk handed to the server at once. A big chunk goes
+# out in pieces so that only a piece, not the whole chunk, is copied into
+# bytes at a time, whatever the chunk's shape.
+#
+BODY_BLOCK_BYTES = 1 << 20
+
+#
+# A chunk filename, e.g. "2_2_2/0-64_64-128_0-64", giving the level and
+# x0, x1, y0, y1, z0, z1
+#
+FILENAME_RE = re.compile(
+    r"^(\d+)(?:_\d+)*/(\d+)-(\d+)_(\d+)-(\d+)_(\d+)-(\d+)$")
+
+
+def load_config(config_file):
+    """Load the config file, reusing the parsed copy if it is unchanged
+
+    :param config_file: path to the JSON list of sources
+    :return: the list of sources
+    """
+    mtime = os.stat(config_file).st_mtime_ns
+    with CONFIG_CACHE_LOCK:
+        cached = CONFIG_CACHE.get(config_file)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(config_file) as fd:
+        config = json.load(fd)
+    sources = {}
+    for source in config:
+        sources.setdefault(source["name"], source)
+    with CONFIG_CACHE_LOCK:
+        CONFIG_CACHE[config_file] = [mtime, config, sources, None]
+    return config
+
+
+def get_source(config_file, name):
+    """Look up a source in the config file by name
+
+    :param config_file: path to the JSON list of sources
+    :param name: the source's name
+    :return: the source or None if there is none by that name
+    """
+    load_config(config_file)
+    with CONFIG_CACHE_LOCK:
+        return CONFIG_CACHE[config_file][2].get(name)
+
+
+@functools.lru_cache(maxsize=64)
+def get_reader(urls, level):
+    """Get a reader for a source, reusing it across requests
+
+    Making a reader loads the metadata of every volume in the source, which
+    costs more than serving a chunk.
+
+    :param urls: a tuple of the source's volume URLs
+    :param level: the mipmap level
+    """
+    return DANDIArrayReader(list(urls), level=level)
+
 
 class ParseFileException(BaseException):
     pass
@@ -81,14 +166,39 @@ def list_one(key):
     return '<li><a href="%s">%s</a></li>' % (url, key)
 
 
-def neuroglancer_listing(start_response, config):
-    result = "<html><body><ul>\n"
-    def sort_fn(d):
-        return d["name"]
-    for d in sorted(config, key=sort_fn):
-        result += list_one(d["name"]) + "\n"
-    result += "</ul></body></html>"
-    data = result.encode("ascii")
+def render_listing(config):
+    """Render the HTML page that links to each source in neuroglancer
+
+    :param config: the list of sources
+    :return: the page as bytes
+    """
+    parts = ["<html><body><ul>\n"]
+    parts.extend(list_one(d["name"]) + "\n"
+                 for d in sorted(config, key=itemgetter("name")))
+    parts.append("</ul></body></html>")
+    return "".join(parts).encode("ascii")
+
+
+def get_listing(config_file):
+    """Get the listing page, rendering it once per change to the config
+
+    :param config_file: path to the JSON list of sources
+    :return: the page as bytes
+    """
+    config = load_config(config_file)
+    with CONFIG_CACHE_LOCK:
+        cached = CONFIG_CACHE[config_file]
+        if cached[1] is config and cached[3] is not None:
+            return cached[3]
+    data = render_listing(config)
+    with CONFIG_CACHE_LOCK:
+        if cached[1] is config:
+            cached[3] = data
+    return data
+
+
+def neuroglancer_listing(start_response, config_file):
+    data = get_listing(config_file)
     start_response(
         "200 OK",
         [("Content-type", "text/html"),
@@ -99,60 +209,70 @@ def neuroglancer_listing(start_response, config):
 
 
 def serve_precomputed(environ, start_response, config_file):
-    with open(config_file) as fd:
-        config = json.load(fd)
     path_info = environ["PATH_INFO"]
     if path_info == "/":
-        return neuroglancer_listing(start_response, config)
-    for source in config:
-        if path_info[1:].startswith(source["name"]+"/"):
-            filename = path_info[2+len(source["name"]):]
-            urls = source["urls"]
-            if filename == "info":
-                return serve_info(environ, start_response, urls)
-            else:
-                try:
-                    level, x0, x1, y0, y1, z0, z1 = \
-                        parse_filename(filename)
-                except ParseFileException:
-                    return file_not_found(path_info, start_response)
-                ar = DANDIArrayReader(urls, level=level)
-                img = ar[z0:z1, y0:y1, x0:x1]
-                data = img.tostring("C")
-                start_response(
-                    "200 OK",
-                    [("Content-type", "application/octet-stream"),
-                     ("Content-Length", str(len(data))),
-                     ('Access-Control-Allow-Origin', '*')])
-                return [data]
-    else:
+        return neuroglancer_listing(start_response, config_file)
+    name, sep, filename = path_info[1:].partition("/")
+    source = get_source(config_file, name)
+    if source is None or not sep:
         return file_not_found(path_info, start_response)
+    urls = source["urls"]
+    if filename == "info":
+        return serve_info(environ, start_response, urls)
+    try:
+        level, x0, x1, y0, y1, z0, z1 = parse_filename(filename)
+    except ParseFileException:
+        return file_not_found(path_info, start_response)
+    ar = get_reader(tuple(urls), level)
+    img = ar[z0:z1, y0:y1, x0:x1]
+    img = np.require(img, img.dtype.newbyteorder("<"), "C")
+    start_response(
+        "200 OK",
+        [("Content-type", "application/octet-stream"),
+         ("Content-Length", str(img.nbytes)),
+         ('Access-Control-Allow-Origin', '*')])
+    data = img.reshape(-1).view(np.uint8)
+    return (data[i:i + BODY_BLOCK_BYTES].tobytes()
+            for i in range(0, data.nbytes, BODY_BLOCK_BYTES))
 
 
 def serve_info(environ, start_response, urls):
-    ar = DANDIArrayReader(urls, level=1)
-    info = ar.get_info()
-    data = json.dumps(info, indent=2, ensure_ascii=True).encode("ascii")
+    key = tuple(urls)
+    now = time.monotonic()
+    with INFO_CACHE_LOCK:
+        cached = INFO_CACHE.get(key)
+    if cached is not None and now - cached[2] < INFO_CACHE_TTL:
+        data, etag = cached[:2]
+    else:
+        ar = get_reader(key, 1)
+        info = ar.get_info()
+        data = json.dumps(info, separators=(",", ":")).encode("ascii")
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with INFO_CACHE_LOCK:
+            INFO_CACHE[key] = (data, etag, now)
+    if environ.get("HTTP_IF_NONE_MATCH") == etag:
+        start_response(
+            "304 Not Modified",
+            [("ETag", etag),
+             ("Cache-Control", "public, max-age=%d" % INFO_CACHE_TTL),
+             ('Access-Control-Allow-Origin', '*')])
+        return []
 
     start_response(
         "200 OK",
         [("Content-type", "application/json"),
          ("Content-Length", str(len(data))),
+         ("ETag", etag),
+         ("Cache-Control", "public, max-age=%d" % INFO_CACHE_TTL),
          ('Access-Control-Allow-Origin', '*')])
     return [data]
 
 
 def parse_filename(filename):
-    try:
-        level, path = filename.split("/")
-        level = int(level.split("_")[0])
-        xstr, ystr, zstr = path.split("_")
-        x0, x1 = [int(x) for x in xstr.split('-')]
-        y0, y1 = [int(y) for y in ystr.split('-')]
-        z0, z1 = [int(z) for z in zstr.split('-')]
-    except ValueError:
+    match = FILENAME_RE.match(filename)
+    if match is None:
         raise ParseFileException()
-    return level, x0, x1, y0, y1, z0, z1
+    return tuple(int(_) for _ in match.groups())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""Kernels for downsampling a block by two to make the next mipmap level
+
+"""
+
+import numpy as np
+
+
+def downsampled_shape(shape):
+    """The shape of a block after downsampling by two
+
+    :param shape: the shape of the source block
+    :return: the shape of the destination block, rounding up on odd edges
+    """
+    return tuple((_ + 1) // 2 for _ in shape)
+
+
+def accumulator_dtype(dtype):
+    """A type that can hold the sum of 8 voxels without overflowing
+
+    Unsigned and boolean voxels sum into the smallest unsigned type that
+    fits, signed voxels into int64 and floating-point voxels into float64.
+
+    :param dtype: the dtype of the source voxels
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "i":
+        return np.dtype(np.int64)
+    if dtype.kind == "f":
+        return np.dtype(np.float64)
+    if dtype.itemsize <= 2:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint64)
+
+
+def downsample_mean(src, out):
+    """Downsample a block by averaging each 2 x 2 x 2 cube of voxels
+
+    Voxels on an odd-sized trailing edge are the mean of the source voxels
+    that are present.
+
+    :param src: the source block
+    :param out: the destination array, of shape downsampled_shape(src.shape).
+    It is written in place and can be a view of a larger block.
+    """
+    if any(_ % 2 == 1 for _ in src.shape):
+        # Repeating the last plane on an odd edge counts each voxel that is
+        # present the same number of times, so the mean is unchanged.
+        src = np.pad(src, [(0, _ % 2) for _ in src.shape], mode="edge")
+    nz, ny, nx = out.shape
+    # Fold the pairs along one axis at a time. Each pass halves the data,
+    # starting with Z where the halves are long contiguous runs.
+    pairs = src.reshape(nz, 2, ny, 2, nx, 2)
+    acc = np.add(pairs[:, 0], pairs[:, 1], dtype=accumulator_dtype(src.dtype))
+    acc = acc[:, :, 0] + acc[:, :, 1]
+    acc = acc[..., 0] + acc[..., 1]
+    if acc.dtype.kind == "f":
+        acc /= 8
+    else:
+        acc //= 8
+    out[:] = acc
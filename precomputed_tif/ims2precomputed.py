@@ -6,6 +6,7 @@ import multiprocessing
 import numpy as np
 import sys
 import tqdm
+import typing
 
 from .blockfs_stack import BlockfsStack
 from blockfs.directory import Directory
@@ -15,6 +16,16 @@ DATASET_NAME:str = None
 H5_FILE:h5py.File = None
 H5_DATASET:h5py.Dataset = None
 DIRECTORY:Directory = None
+#
+# The Z, Y and X size of the region each task reads from the HDF5 file
+#
+TILE:typing.Tuple[int, int, int] = (256, 256, 256)
+#
+# Each worker's HDF5 chunk cache. Tiles are aligned to the HDF5 chunks, so
+# every chunk is read whole and can be evicted first (w0 = 1).
+#
+H5_CACHE_BYTES = 64 * 1024 * 1024
+H5_CACHE_SLOTS = 10007
 
 
 def parse_args(args=sys.argv[1:]):
@@ -46,30 +57,75 @@ def parse_args(args=sys.argv[1:]):
     return parser.parse_args(args)
 
 
-def check_open():
-    global H5_FILE, H5_DATASET
-    if not H5_DATASET:
-        H5_FILE = h5py.File(SOURCE, "r")
-        H5_DATASET = H5_FILE[DATASET_NAME]
+def tile_shape(chunks, minimum=256, maximum=1024):
+    """The shape of the region a task reads
+
+    Each side is the smallest multiple of both the HDF5 chunk size and the
+    64-voxel blockfs block size that is at least ``minimum``, so that no
+    HDF5 chunk is split between tasks. A side that would be larger than
+    ``maximum``, e.g. for a chunk size of 100, is left at ``minimum`` and
+    split chunks are served from the chunk cache.
+
+    :param chunks: the dataset's HDF5 chunk shape or None if it is not
+    chunked
+    :param minimum: the smallest size for a side
+    :param maximum: the largest size for a side
+    :return: the Z, Y and X size of the tile
+    """
+    if chunks is None:
+        return (minimum, ) * 3
+    tile = []
+    for chunk in chunks:
+        step = int(np.lcm(chunk, 64))
+        side = (minimum + step - 1) // step * step
+        tile.append(side if side <= maximum else minimum)
+    return tuple(tile)
+
+
+def init_worker(source, dataset_name, directory, tile):
+    """Initialize a write_level_1 worker process
+
+    The HDF5 file is opened once per worker and stays open for all of the
+    worker's blocks.
+
+    :param source: the path to the .ims file
+    :param dataset_name: the HDF5 path of the channel's dataset
+    :param directory: the level 1 blockfs directory. Its writer processes
+    must already have been started in the parent.
+    :param tile: the Z, Y and X size of the region read by each task
+    """
+    global SOURCE, DATASET_NAME, H5_FILE, H5_DATASET, DIRECTORY, TILE
+    SOURCE = source
+    DATASET_NAME = dataset_name
+    DIRECTORY = directory
+    TILE = tile
+    H5_FILE = h5py.File(source, "r",
+                        rdcc_nbytes=H5_CACHE_BYTES,
+                        rdcc_nslots=H5_CACHE_SLOTS,
+                        rdcc_w0=1.0)
+    H5_DATASET = H5_FILE[dataset_name]
 
 
 def write_one(x0, y0, z0):
-    check_open()
-    x1 = min(x0 + 256, H5_DATASET.shape[2])
-    y1 = min(y0 + 256, H5_DATASET.shape[1])
-    z1 = min(z0 + 256, H5_DATASET.shape[0])
+    x1 = min(x0 + TILE[2], H5_DATASET.shape[2])
+    y1 = min(y0 + TILE[1], H5_DATASET.shape[1])
+    z1 = min(z0 + TILE[0], H5_DATASET.shape[0])
     block = H5_DATASET[z0:z1, y0:y1, x0:x1]
+    get_block_size = DIRECTORY.get_block_size
+    write_block = DIRECTORY.write_block
     for x0a, y0a, z0a in itertools.product(
             range(x0, x1, 64),
             range(y0, y1, 64),
             range(z0, z1, 64)):
-        zs, ys, xs = DIRECTORY.get_block_size(x0a, y0a, z0a)
-        x1a = x0a + xs
-        y1a = y0a + ys
-        z1a = z0a + zs
-        DIRECTORY.write_block(
-            block[z0a-z0:z1a-z0, y0a-y0:y1a-y0,x0a-x0:x1a-x0],
-            x0a, y0a, z0a)
+        zs, ys, xs = get_block_size(x0a, y0a, z0a)
+        # Offsets of the blockfs block within the tile
+        xb, yb, zb = x0a - x0, y0a - y0, z0a - z0
+        write_block(block[zb:zb + zs, yb:yb + ys, xb:xb + xs],
+                    x0a, y0a, z0a)
+
+
+def write_one_star(coords):
+    write_one(*coords)
 
 
 def write_level_1(args, stack:BlockfsStack):
@@ -77,16 +133,19 @@ def write_level_1(args, stack:BlockfsStack):
     DIRECTORY = stack.make_l1_directory(args.n_cores)
     DIRECTORY.create()
     DIRECTORY.start_writer_processes()
-    x0s = np.arange(0, stack.x_extent, 256)
-    y0s = np.arange(0, stack.y_extent, 256)
-    z0s = np.arange(0, stack.z_extent, 256)
-    with multiprocessing.Pool(args.n_cores) as pool:
-        futures = []
-        for x0, y0, z0 in itertools.product(x0s, y0s, z0s):
-            futures.append(pool.apply_async(
-                write_one, (x0, y0, z0)))
-        for future in tqdm.tqdm(futures):
-            future.get()
+    with h5py.File(SOURCE, "r") as fd:
+        tile = tile_shape(fd[DATASET_NAME].chunks)
+    coords = list(itertools.product(range(0, stack.x_extent, tile[2]),
+                                    range(0, stack.y_extent, tile[1]),
+                                    range(0, stack.z_extent, tile[0])))
+    with multiprocessing.Pool(args.n_cores,
+                              initializer=init_worker,
+                              initargs=(SOURCE, DATASET_NAME, DIRECTORY,
+                                        tile)) \
+            as pool:
+        for _ in tqdm.tqdm(pool.imap_unordered(write_one_star, coords),
+                           total=len(coords)):
+            pass
         DIRECTORY.close()
 
 
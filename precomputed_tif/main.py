@@ -1,5 +1,7 @@
 import argparse
 import logging
+import multiprocessing
+import numcodecs
 import sys
 import zarr
 
@@ -41,6 +43,14 @@ def parse_args(args=sys.argv[1:]):
     parser.add_argument("--segmentation",
                         help="If present, the volume will be saved as a segmentation instead of a 3d image",
                         action="store_true")
+    parser.add_argument("--compressor",
+                        default="zstd",
+                        help="The Blosc compressor for ngff chunks, e.g. "
+                             "\"zstd\" or \"lz4\" for faster writes.")
+    parser.add_argument("--compression-level",
+                        type=int,
+                        default=3,
+                        help="The Blosc compression level for ngff chunks.")
     return parser.parse_args(args)
 
 
@@ -63,7 +73,9 @@ def main(args=sys.argv[1:]):
         stack = BlockfsStack(args.source, args.dest, ptype=ptype, **kwargs)
     elif args.format == 'ngff':
         stack = NGFFStack(args.source, args.dest, **kwargs)
-        stack.create()
+        stack.create(compressor=numcodecs.Blosc(
+            args.compressor, args.compression_level,
+            shuffle=numcodecs.Blosc.BITSHUFFLE))
     else:
         stack = Stack(args.source, args.dest, ptype=ptype, **kwargs)
     if args.format != 'zarr':
@@ -74,6 +86,16 @@ def main(args=sys.argv[1:]):
 
     voxel_size = [int(float(_) * 1000) for _ in args.voxel_size.split(",")]
     stack.write_info_file(args.levels, voxel_size)
+    if args.format == 'ngff':
+        #
+        # NGFF tasks carry their zarr arrays with them, so one pool can
+        # serve every level.
+        #
+        with multiprocessing.Pool(args.n_cores) as pool:
+            stack.write_level_1(pool=pool)
+            for level in range(2, args.levels+1):
+                stack.write_level_n(level, pool=pool)
+        return
     stack.write_level_1(**kwargs)
     for level in range(2, args.levels+1):
         stack.write_level_n(level, **kwargs)
@@ -1,21 +1,90 @@
+import contextlib
 import itertools
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 import numcodecs
 import numpy as np
 import tifffile
 import tqdm
-import typing
-
-from scipy import ndimage
 
+from .downsample import downsample_mean, downsampled_shape
 from .stack import StackBase, PType
 import pathlib
-import scipy
-import uuid
 import zarr
 
-DATASETS:typing.Mapping[uuid.UUID, zarr.Array] = {}
+#
+# Each worker reads its level 1 slabs and level n source blocks into this
+# buffer, growing it when a larger block or a different dtype comes along.
+#
+SCRATCH:np.ndarray = None
+#
+# The number of threads in each level 1 worker that read its TIFF planes.
+# Decoding releases the GIL, so one plane's IO overlaps another's decode.
+#
+READ_THREADS = 4
+#
+# Each worker's zarr arrays, keyed by store path and dataset name. Tasks
+# name their arrays rather than carry them, because unpickling an array
+# reads its .zarray again.
+#
+DATASETS = {}
+
+
+def scratch_buffer(shape, dtype):
+    """A view of the worker's scratch buffer with the given shape and dtype
+
+    :param shape: the shape of the array needed
+    :param dtype: the dtype of the array needed
+    :return: an uninitialized array that is reused by the next call
+    """
+    global SCRATCH
+    size = int(np.prod(shape))
+    if SCRATCH is None or SCRATCH.dtype != dtype or SCRATCH.size < size:
+        SCRATCH = np.empty(size, dtype)
+    return SCRATCH[:size].reshape(shape)
+
+
+def init_worker(dest, names):
+    """Initialize a worker of a pool made for one level
+
+    :param dest: the path to the NGFF store
+    :param names: the names of the datasets the level's tasks use
+    """
+    for name in names:
+        get_worker_dataset(dest, name)
+
+
+def get_worker_dataset(dest, name):
+    """Get a dataset, opening it if the worker has not already
+
+    Workers of a pool shared by several levels open each dataset on its
+    first task.
+
+    :param dest: the path to the NGFF store
+    :param name: the name of the dataset in the store, e.g. "0"
+    :return: the zarr array
+    """
+    key = (dest, name)
+    if key not in DATASETS:
+        DATASETS[key] = zarr.open(
+            zarr.NestedDirectoryStore(dest), mode="r+", path=name)
+    return DATASETS[key]
+
+
+def read_plane(path, out):
+    """Read a TIFF plane into a slice of a level 1 slab
+
+    :param path: the path to the TIFF file
+    :param out: the 2-d array to fill
+    """
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        if series.dtype == out.dtype and series.shape == out.shape:
+            # Decode straight into the slab
+            tif.asarray(out=out)
+        else:
+            out[:] = tif.asarray()
 
 
 class NGFFStack(StackBase):
@@ -37,12 +106,16 @@ class NGFFStack(StackBase):
         path = pathlib.Path(self.dest)
         self.name = path.stem
 
-    def create(self, mode="w", compressor=numcodecs.Blosc("zstd", 5)):
+    def create(self, mode="w",
+               compressor=numcodecs.Blosc("zstd", 3,
+                                          shuffle=numcodecs.Blosc.BITSHUFFLE)):
         """
         Create or open for append a dataset
 
-        :param n_channels: # of channels in the zarr
-        :param current_channel: the channel to be written
+        :param mode: "w" to overwrite an existing dataset
+        :param compressor: the numcodecs compressor for the chunks. The
+        default, zstd level 3 with bit shuffling, keeps compression from
+        being the bottleneck while still packing 16-bit microscopy data well.
         """
         store = zarr.NestedDirectoryStore(
             self.dest)
@@ -58,14 +131,20 @@ class NGFFStack(StackBase):
         the info file
         """
         super(NGFFStack, self).write_info_file(n_levels, voxel_size)
+        if np.dtype(self.dtype).kind == "f":
+            info = np.finfo(self.dtype)
+            window = dict(min=float(info.min), max=float(info.max))
+        else:
+            info = np.iinfo(self.dtype)
+            window = dict(min=int(info.min), max=int(info.max))
 
         self.zgroup.attrs["multiscales"] = [dict(
                 version=self.VERSION,
                 name=self.name,
                 type=self.TYPE,
                 metadata=dict(
-                    method="scipy.ndimage.map_coordinates",
-                    version=scipy.__version__
+                    method="numpy.mean",
+                    version=np.__version__
                 ),
                 datasets=[dict(path=str(i)) for i in range(n_levels)]
 
@@ -81,10 +160,7 @@ class NGFFStack(StackBase):
                         family="linear",
                         inverted=False,
                         label=self.name,
-                        window=dict(
-                            min=np.iinfo(self.dtype).min,
-                            max=np.iinfo(self.dtype).max
-                        )
+                        window=window
                     )
                 ],
                 rdefs=dict(
@@ -94,71 +170,88 @@ class NGFFStack(StackBase):
                 )
             )
 
+    @staticmethod
+    @contextlib.contextmanager
+    def pool_context(n_cores, pool, dest, names):
+        """The pool to run a level's tasks on
+
+        :param n_cores: the number of processes if a pool is made
+        :param pool: a pool shared by all the levels or None to make one
+        for this level alone
+        :param dest: the path to the NGFF store
+        :param names: the datasets that the workers of a new pool open
+        when they start
+        """
+        if pool is None:
+            with multiprocessing.Pool(n_cores, initializer=init_worker,
+                                      initargs=(dest, names)) as pool:
+                yield pool
+        else:
+            yield pool
+
     def write_level_1(self, silent=False,
-                      n_cores=min(multiprocessing.cpu_count(), 4)):
+                      n_cores=min(multiprocessing.cpu_count(), 4),
+                      pool=None):
+        """Write the first level of the pyramid from the source files
+
+        :param silent: True to suppress the progress bar
+        :param n_cores: the number of processes to use if no pool is given
+        :param pool: a multiprocessing pool to run the tasks on. Passing the
+        same pool to every level saves starting new workers for each one.
+        """
         z0 = self.z0(1)
         z1 = self.z1(1)
-        y0 = self.y0(1)
-        y1 = self.y1(1)
-        x0 = self.x0(1)
-        x1 = self.x1(1)
-        dataset = self.create_dataset(1)
-        my_id = uuid.uuid4()
-        try:
-            DATASETS[my_id] = dataset
-            with multiprocessing.Pool(n_cores) as pool:
-                futures = []
-                for z0a, z1a in zip(z0, z1):
-                    files = self.files[z0a:z1a]
-                    futures.append(pool.apply_async(
-                        self.write_one_level_1,
-                        (my_id, files, x0, x1, y0, y1, z0a, z1a)))
-                for future in tqdm.tqdm(futures, disable=silent):
-                    future.get()
-        finally:
-            del DATASETS[my_id]
+        self.create_dataset(1)
+        name = self.dataset_name(1)
+        tasks = ((self.dest, name, self.files[z0a:z1a], z0a, z1a)
+                 for z0a, z1a in zip(z0, z1))
+        with self.pool_context(n_cores, pool, self.dest, [name]) as pool:
+            for _ in tqdm.tqdm(
+                    pool.imap_unordered(write_one_level_1_star, tasks),
+                    total=len(z0), disable=silent):
+                pass
 
     @staticmethod
-    def write_one_level_1(dataset_id,
-            files, x0, x1, y0, y1, z0, z1):
-        dataset = DATASETS[dataset_id]
+    def write_one_level_1(dest, name, files, z0, z1):
+        dataset = get_worker_dataset(dest, name)
         y_extent, x_extent = dataset.shape[-2:]
-        img = np.zeros((1, 1, z1-z0, y_extent, x_extent), dataset.dtype)
-        for z, file in zip(range(z0, z1), files):
-            img[0, 0, z - z0] = \
-                tifffile.imread(file)
-        for (x0a, x1a), (y0a, y1a) in itertools.product(
-                zip(x0, x1), zip(y0, y1)):
-            dataset[:, :, z0:z1, y0a:y1a, x0a:x1a] = \
-                img[:, :, :, y0a:y1a, x0a:x1a]
+        # Every plane of the slab is read in full, so it needn't be zeroed
+        img = scratch_buffer((1, 1, z1-z0, y_extent, x_extent), dataset.dtype)
+        with ThreadPoolExecutor(READ_THREADS) as executor:
+            for _ in executor.map(read_plane, files, img[0, 0]):
+                pass
+        # zarr splits the slab into chunks itself
+        dataset[:, :, z0:z1] = img
 
     def write_level_n(self, level,
                       silent=False,
-                      n_cores=min(multiprocessing.cpu_count(), 13)):
-        src_dataset = self.get_dataset(level - 1)
-        dest_dataset = self.create_dataset(level)
-        src_id = uuid.uuid4()
-        dest_id = uuid.uuid4()
-        DATASETS[src_id] = src_dataset
-        DATASETS[dest_id] = dest_dataset
-        try:
-            with multiprocessing.Pool(n_cores) as pool:
-                futures = []
-                for (x0, x1), (y0, y1), (z0, z1) in \
-                    itertools.product(zip(self.x0(level), self.x1(level)),
-                                      zip(self.y0(level), self.y1(level)),
-                                      zip(self.z0(level), self.z1(level))):
-                    futures.append(pool.apply_async(
-                        NGFFStack.write_one_level_n,
-                        (src_id, dest_id, x0, x1, y0, y1, z0, z1, self.ptype)
-                    ))
-                for future in tqdm.tqdm(futures,
-                                        desc="Writing level %d" % level,
-                                        disable=silent):
-                    future.get()
-        finally:
-            del DATASETS[src_id]
-            del DATASETS[dest_id]
+                      n_cores=min(multiprocessing.cpu_count(), 13),
+                      pool=None):
+        """Write a level of the pyramid by downsampling the one before it
+
+        :param level: the level to write, starting at 2
+        :param silent: True to suppress the progress bar
+        :param n_cores: the number of processes to use if no pool is given
+        :param pool: a multiprocessing pool to run the tasks on, e.g. the
+        one used for the previous levels
+        """
+        self.create_dataset(level)
+        names = [self.dataset_name(level - 1), self.dataset_name(level)]
+        ranges = self.ranges(level)
+        xr, yr, zr = ranges["x"].T, ranges["y"].T, ranges["z"].T
+        tasks = ((self.dest, *names, x0, x1, y0, y1, z0, z1, self.ptype)
+                 for (x0, x1), (y0, y1), (z0, z1) in
+                 itertools.product(xr, yr, zr))
+        n_tasks = len(xr) * len(yr) * len(zr)
+        chunksize = max(1, n_tasks // (n_cores * 4))
+        with self.pool_context(n_cores, pool, self.dest, names) as pool:
+            for _ in tqdm.tqdm(
+                    pool.imap_unordered(write_one_level_n_star, tasks,
+                                        chunksize=chunksize),
+                    total=n_tasks,
+                    desc="Writing level %d" % level,
+                    disable=silent):
+                pass
 
     def get_dataset(self, level):
         """
@@ -166,7 +259,16 @@ class NGFFStack(StackBase):
 
         :param level: 1-based index of the level
         """
-        return self.zgroup[str(level - 1)]
+        return self.zgroup[self.dataset_name(level)]
+
+    @staticmethod
+    def dataset_name(level):
+        """
+        The name of the ZARR array at a given level
+
+        :param level: 1-based index of the level
+        """
+        return str(level - 1)
 
     def create_dataset(self, level:int):
         """
@@ -174,11 +276,12 @@ class NGFFStack(StackBase):
 
         :param level: level, starting at index=1
         """
+        resolution = self.resolution(level)
         x_extent, y_extent, z_extent = [
-            (extent + self.resolution(level) - 1) // self.resolution(level)
+            (extent + resolution - 1) // resolution
             for extent in (self.x_extent, self.y_extent, self.z_extent)]
         dest_dataset = self.zgroup.create_dataset(
-            str(level - 1),
+            self.dataset_name(level),
             shape=(1, 1, z_extent, y_extent, x_extent),
             chunks=(1, 1, self.cz(), self.cy(), self.cx()),
             dtype=self.dtype,
@@ -189,18 +292,37 @@ class NGFFStack(StackBase):
         return dest_dataset
 
     @staticmethod
-    def write_one_level_n(src_id, dest_id, x0, x1, y0, y1, z0, z1, ptype):
-        src_dataset = DATASETS[src_id]
-        dest_dataset = DATASETS[dest_id]
+    def write_one_level_n(dest, src_name, dest_name,
+                          x0, x1, y0, y1, z0, z1, ptype):
+        src_dataset = get_worker_dataset(dest, src_name)
+        dest_dataset = get_worker_dataset(dest, dest_name)
         z1s, y1s, x1s = [min(a * 2, b) for a, b in zip((z1, y1, x1),
                                                         src_dataset.shape[2:])]
-        src_block = src_dataset[0, 0, z0 * 2:z1s, y0 * 2: y1s, x0 * 2: x1s]
-        if np.all(src_block == 0):
+        src_block = scratch_buffer((z1s - z0 * 2, y1s - y0 * 2, x1s - x0 * 2),
+                                   src_dataset.dtype)
+        src_dataset.get_basic_selection(
+            (0, 0, slice(z0 * 2, z1s), slice(y0 * 2, y1s),
+             slice(x0 * 2, x1s)), out=src_block)
+        if not np.any(src_block):
             # Don't bother writing out an empty slot
             return
-        zs,ys,xs = np.mgrid[0:z1-z0, 0:y1-y0, 0:x1-x0] * 2 + .5
-        order = 0 if ptype == PType.SEGMENTATION else 1
-        dest_block = ndimage.map_coordinates(src_block, (zs, ys, xs),
-                                             order=order,
-                                             mode="nearest")
+        if ptype == PType.SEGMENTATION:
+            # Labels can't be averaged, so take one voxel of each 2x2x2:
+            # the far corner, or the last voxel at an odd edge, as
+            # nearest-neighbor sampling at 2i + .5 did before.
+            dest_block = src_block[np.ix_(*[
+                np.minimum(np.arange(1, n + 1, 2), n - 1)
+                for n in src_block.shape])]
+        else:
+            dest_block = np.empty(downsampled_shape(src_block.shape),
+                                  src_block.dtype)
+            downsample_mean(src_block, dest_block)
         dest_dataset[0, 0, z0:z1, y0:y1, x0:x1] = dest_block
+
+
+def write_one_level_1_star(args):
+    NGFFStack.write_one_level_1(*args)
+
+
+def write_one_level_n_star(args):
+    NGFFStack.write_one_level_n(*args)
@@ -1,12 +1,14 @@
 # Convert any precomputed format to NGFF format
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 import multiprocessing
 import json
 import sys
 import tqdm
 from .ngff_stack import NGFFStack
-from .client import ArrayReader
+from .client import ArrayReader, set_cache_bytes
 from urllib.request import urlopen
 
 def parse_args(args=sys.argv[1:]):
@@ -33,22 +35,109 @@ def parse_args(args=sys.argv[1:]):
     )
     parser.add_argument(
         "--n-workers",
+        type=int,
         help="# of worker processes",
         default=min(multiprocessing.cpu_count(), 24)
     )
+    parser.add_argument(
+        "--group-size",
+        type=int,
+        help="# of chunks along X to read from the input at once. Larger "
+             "groups mean fewer, bigger reads, which is faster for remote "
+             "inputs.",
+        default=8
+    )
     return parser.parse_args(args)
 
 
-ARRAY_READER = None
-ZARR = None
+#
+# Each worker's array readers, keyed by URL, format and level, so that a
+# worker opens a level once however many of its chunks it copies.
+#
+ARRAY_READERS = {}
+#
+# The number of reads a worker keeps in flight while it writes the ones
+# that have arrived, and the worker's thread pool that does them. The pool
+# is made in the worker, on its first batch.
+#
+N_PREFETCH = 4
+PREFETCH_EXECUTOR:ThreadPoolExecutor = None
+
+
+def init_worker():
+    """Initialize a conversion worker process
+
+    Every chunk is read once, so the client's chunk cache would only hold
+    chunks that are never asked for again. It is turned off.
+    """
+    set_cache_bytes(0)
+
+
+def get_array_reader(url, input_format, level):
+    """Get the worker's reader for a level of the input
+
+    :param url: the URL of the input source
+    :param input_format: the format of the input if it is a file URL
+    :param level: the mipmap level, starting at 1
+    """
+    key = (url, input_format, level)
+    if key not in ARRAY_READERS:
+        ARRAY_READERS[key] = ArrayReader(
+            url, format=input_format, level=2 ** (level - 1))
+    return ARRAY_READERS[key]
+
+
+def do_batch(url, input_format, level, dataset, bounds):
+    """Copy a batch of blocks, reading ahead while earlier ones are written
+
+    Up to N_PREFETCH reads are in flight at a time, so the latency of the
+    input overlaps compressing and writing the zarr chunks.
+
+    :param url: the URL of the input source
+    :param input_format: the format of the input if it is a file URL
+    :param level: the mipmap level, starting at 1
+    :param dataset: the zarr array for the level
+    :param bounds: a sequence of (x0, x1, y0, y1, z0, z1) blocks to copy
+    :return: the number of blocks copied
+    """
+    global PREFETCH_EXECUTOR
+    if PREFETCH_EXECUTOR is None:
+        PREFETCH_EXECUTOR = ThreadPoolExecutor(N_PREFETCH)
+    array_reader = get_array_reader(url, input_format, level)
+
+    def read(x0, x1, y0, y1, z0, z1):
+        return array_reader[z0:z1, y0:y1, x0:x1]
+
+    def write(x0, x1, y0, y1, z0, z1, future):
+        dataset[0, 0, z0:z1, y0:y1, x0:x1] = future.result()
+
+    pending = collections.deque()
+    for b in bounds:
+        pending.append((*b, PREFETCH_EXECUTOR.submit(read, *b)))
+        if len(pending) >= N_PREFETCH:
+            write(*pending.popleft())
+    while pending:
+        write(*pending.popleft())
+    return len(bounds)
+
+
+def do_batch_star(args):
+    return do_batch(*args)
+
 
+def grouped_ranges(starts, ends, group_size):
+    """Merge runs of adjacent chunks into single ranges
 
-def do_one(level, x0, x1, y0, y1, z0, z1):
-    ZARR[0, 0, z0:z1, y0:y1, x0:x1] = ARRAY_READER[z0:z1, y0:y1, x0:x1]
+    :param starts: the starting coordinates of the chunks along an axis
+    :param ends: the ending coordinates of the chunks along an axis
+    :param group_size: the number of chunks to merge into each range
+    :return: a list of the (start, end) of each group of chunks
+    """
+    return [(starts[i], ends[min(i + group_size, len(ends)) - 1])
+            for i in range(0, len(starts), group_size)]
 
 
 def main(args=sys.argv[1:]):
-    global ARRAY_READER, ZARR
     opts = parse_args(args)
     ar0 = ArrayReader(opts.input, format=opts.input_format)
     stack = NGFFStack(ar0.shape, opts.output,
@@ -66,23 +155,36 @@ def main(args=sys.argv[1:]):
 
     stack.create()
     stack.write_info_file(levels, voxel_size=resolution)
-    for level in range(1, levels+1):
-        ARRAY_READER = ArrayReader(
-            opts.input,
-            format=opts.input_format,
-            level=2 ** (level - 1))
-        ZARR = stack.create_dataset(level)
-        with multiprocessing.Pool(opts.n_workers) as pool:
-            futures = []
-            for (x0, x1), (y0, y1), (z0, z1) in itertools.product(
-                    zip(stack.x0(level), stack.x1(level)),
-                    zip(stack.y0(level), stack.y1(level)),
-                    zip(stack.z0(level), stack.z1(level))):
-                futures.append(pool.apply_async(
-                    do_one,
-                    (level, x0, x1, y0, y1, z0, z1)))
-            for future in tqdm.tqdm(futures):
-                future.get()
+    #
+    # Each task carries its zarr array and level, so one pool of workers
+    # copies every level.
+    #
+    with multiprocessing.Pool(opts.n_workers,
+                              initializer=init_worker) as pool:
+        for level in range(1, levels+1):
+            dataset = stack.create_dataset(level)
+            #
+            # A task covers a run of chunks along X: it makes one read of
+            # the input and zarr splits the write into chunks.
+            #
+            x_ranges = grouped_ranges(stack.x0(level), stack.x1(level),
+                                      opts.group_size)
+            bounds = [(x0, x1, y0, y1, z0, z1)
+                      for (x0, x1), (y0, y1), (z0, z1) in itertools.product(
+                          x_ranges,
+                          zip(stack.y0(level), stack.y1(level)),
+                          zip(stack.z0(level), stack.z1(level)))]
+            #
+            # Each worker gets its blocks in batches so that it can read
+            # ahead within a batch.
+            #
+            batch_size = max(1, len(bounds) // (opts.n_workers * 4))
+            tasks = ((opts.input, opts.input_format, level, dataset,
+                      bounds[i:i + batch_size])
+                     for i in range(0, len(bounds), batch_size))
+            with tqdm.tqdm(total=len(bounds)) as progress:
+                for n in pool.imap_unordered(do_batch_star, tasks):
+                    progress.update(n)
 
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,12 @@
 # imports
-from precomputed_tif.client import ArrayReader
+from precomputed_tif.client import ArrayReader, set_cache_bytes
 import pathlib
 import tifffile
 import math
 from functools import partial
 import argparse
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 parser = argparse.ArgumentParser()
 parser.add_argument('--input-file-path', help='path of input file', required= True)
 parser.add_argument('--output-file-path', help='path of output file', required= True)
@@ -16,21 +17,39 @@ parser.add_argument('--x0', help='x0 value', type=int, required= True)
 parser.add_argument('--x1', help='x1 value', type=int,required= True)
 args = parser.parse_args()
 
-def subset_image_mult(input_file_path, output_file_path, chunk, y0, y1 , x0,x1, iteration): 
+# Each worker's reader for the input volume, opened once by init_worker
+ARRAY_READER = None
+
+
+def init_worker(input_file_path):
+    global ARRAY_READER
+    # Each worker reads its own slabs once, so caching chunks or reading
+    # ahead into the next worker's slabs is wasted work
+    set_cache_bytes(0)
     path = pathlib.Path("{file_path}".format(file_path=input_file_path))
     # ArrayReader takes the URL form of the path and it points to a blockfs volume
-    array_reader = ArrayReader(path.as_uri(), format="blockfs")
+    ARRAY_READER = ArrayReader(path.as_uri(), format="blockfs",
+                               prefetch_depth=0)
+
+
+def subset_image_mult(output_file_path, chunk, y0, y1 , x0,x1, iteration): 
+    array_reader = ARRAY_READER
     z_y_x_dim = array_reader.shape 
     z_dim= z_y_x_dim[0]
     max_num_iterations= math.ceil(z_dim/chunk)
     if iteration <= max_num_iterations: 
-        chunk_size=chunk
-        start= z_dim - (z_dim- (chunk_size*(iteration-1)) )
-        end = start+ chunk_size 
+        start = chunk * (iteration - 1)
+        end = min(start + chunk, z_dim)
         block= array_reader[start:end, y0:y1, x0:x1] 
-        ind=list(range(start,end))
-        for i,j in enumerate(block):
-            tifffile.imsave("{output_path}/image_{index_number_z:04d}.tiff".format(output_path=output_file_path,index_number_z=ind[i]), j)
+
+        def write_plane(z, plane):
+            tifffile.imsave(f"{output_file_path}/image_{z:04d}.tiff", plane)
+
+        # Compressing and writing the planes releases the GIL, so a few
+        # threads write them at once.
+        with ThreadPoolExecutor(4) as executor:
+            for _ in executor.map(write_plane, range(start, end), block):
+                pass
     else:
         print(f" The max number of iterations is {max_num_iterations}")
 
@@ -39,14 +58,12 @@ def main():
     ar = ArrayReader(p.as_uri(), format="blockfs")
     dim = ar.shape
     z_dimension = dim[0]
-    max_iterations = math.ceil(z_dimension / 64)
-    with multiprocessing.Pool() as pool:
-        futures = []
-        for z in range(1, max_iterations + 1):
-            futures.append(pool.apply_async(
-                partial(subset_image_mult, args.input_file_path, args.output_file_path, args.chunk, args.y0, args.y1,
-                        args.x0, args.x1), (z,)))
-        for future in futures:
-            future.get()
+    max_iterations = math.ceil(z_dimension / args.chunk)
+    with multiprocessing.Pool(initializer=init_worker,
+                              initargs=(args.input_file_path,)) as pool:
+        for _ in pool.imap_unordered(
+                partial(subset_image_mult, args.output_file_path, args.chunk, args.y0, args.y1,
+                        args.x0, args.x1), range(1, max_iterations + 1)):
+            pass
 if __name__ == "__main__":
     main()
@@ -112,7 +112,11 @@ def main(args=sys.argv[1:]):
         axis = 0
     chunk = read_chunk(options.url, x0, x1, y0, y1, z0, z1, level,
                        format=options.format)
-    projection = np.max(chunk, axis)
+    if chunk.shape[axis] == 1:
+        # A single plane: there is nothing to project
+        projection = chunk.squeeze(axis)
+    else:
+        projection = np.max(chunk, axis)
     if options.rotate_right:
         projection = np.rot90(projection, 1)
     if options.rotate_180:
@@ -9,6 +9,42 @@ import tqdm
 import multiprocessing
 from PIL import Image
 
+from .downsample import downsample_mean, downsampled_shape
+
+#
+# The deflate level for the TIFF blocks. Noisy microscopy planes barely
+# compress better at higher levels, so the fastest level is used.
+#
+TIFF_COMPRESS_LEVEL = 1
+
+#
+# JPEG voxels below 20 are set to zero. For 8-bit images this is a lookup
+# table, applied in the one pass that copies the image out of PIL.
+#
+JPEG_THRESHOLD = 20
+JPEG_LUT = np.arange(256, dtype=np.uint8)
+JPEG_LUT[:JPEG_THRESHOLD] = 0
+
+#
+# Per-worker state for Stack.write_level_n, installed by init_level_n_worker
+#
+LEVEL_N_ARGS:tuple = None
+
+
+def init_level_n_worker(args):
+    """Initialize a Stack.write_level_n worker process
+
+    :param args: a tuple of dest, dtype, level, x0d, x0s, x1d, x1s, xsi_max,
+    y0d, y0s, y1d, y1s, ysi_max, z0d, z0s, z1d, z1s, zsi_max, cx, cy, cz
+    """
+    global LEVEL_N_ARGS
+    LEVEL_N_ARGS = args
+
+
+def write_one_level_n_star(idxs):
+    return Stack.write_one_level_n(*idxs)
+
+
 class PType(enum.Enum):
     IMAGE="image"
     SEGMENTATION="segmentation"
@@ -38,6 +74,7 @@ class StackBase:
             self.dtype = dtype or img0.dtype
         self.dest = dest
         self.chunksize = chunk_size
+        self._ranges = {}
 
     @staticmethod
     def resolution(level):
@@ -61,6 +98,30 @@ class StackBase:
         """Chunksize in Z direction"""
         return self.chunksize[0]
 
+    def ranges(self, level):
+        """The block boundaries at a particular level
+
+        The boundaries are computed once per level and are read-only.
+
+        :param level: the mipmap level (1 to N)
+        :return: a dictionary of "x", "y" and "z" to a 2 x N array whose
+        rows are the starting and ending coordinates of the blocks
+        """
+        if level not in self._ranges:
+            resolution = self.resolution(level)
+            ranges = {}
+            for axis, extent, chunk in (("x", self.x_extent, self.cx()),
+                                        ("y", self.y_extent, self.cy()),
+                                        ("z", self.z_extent, self.cz())):
+                end = (extent + resolution - 1) // resolution
+                starts = np.arange(0, end, chunk)
+                r = np.stack((starts, starts + chunk))
+                r[1, -1] = end
+                r.flags.writeable = False
+                ranges[axis] = r
+            self._ranges[level] = ranges
+        return self._ranges[level]
+
     def n_x(self, level):
         """The number of blocks in the X direction at the given level
 
@@ -75,9 +136,7 @@ class StackBase:
         :param level: 1 to N
         :return: an array of starting X coordinates
         """
-        resolution = self.resolution(level)
-        return np.arange(0, (self.x_extent + resolution - 1) // resolution,
-                         self.cx())
+        return self.ranges(level)["x"][0]
 
     def x1(self, level):
         """The ending X coordinates at a particular level
@@ -85,10 +144,7 @@ class StackBase:
         :param level: the mipmap level (1 to N)
         :return: an array of ending X coordinates
         """
-        resolution = self.resolution(level)
-        x1 = self.x0(level) + self.cx()
-        x1[-1] = (self.x_extent + resolution - 1) // resolution
-        return x1
+        return self.ranges(level)["x"][1]
 
     def n_y(self, level):
         """The number of blocks in the Y direction at the given level
@@ -104,9 +160,7 @@ class StackBase:
         :param level: 1 to N
         :return: an array of starting Y coordinates
         """
-        resolution = self.resolution(level)
-        return np.arange(0, (self.y_extent + resolution - 1) // resolution,
-                         self.cy())
+        return self.ranges(level)["y"][0]
 
     def y1(self, level):
         """The ending Y coordinates at a particular level
@@ -114,10 +168,7 @@ class StackBase:
         :param level: the mipmap level (1 to N)
         :return: an array of ending Y coordinates
         """
-        resolution = self.resolution(level)
-        y1 = self.y0(level) + self.cy()
-        y1[-1] = (self.y_extent + resolution - 1) // resolution
-        return y1
+        return self.ranges(level)["y"][1]
 
     def n_z(self, level):
         """The number of blocks in the Z direction at the given level
@@ -133,9 +184,7 @@ class StackBase:
         :param level: 1 to N
         :return: an array of starting Z coordinates
         """
-        resolution = self.resolution(level)
-        return np.arange(0, (self.z_extent + resolution - 1) // resolution,
-                         self.cz())
+        return self.ranges(level)["z"][0]
 
     def z1(self, level):
         """The ending Z coordinates at a particular level
@@ -143,10 +192,7 @@ class StackBase:
         :param level: the mipmap level (1 to N)
         :return: an array of ending Z coordinates
         """
-        resolution = self.resolution(level)
-        z1 = self.z0(level) + self.cz()
-        z1[-1] = (self.z_extent + resolution - 1) // resolution
-        return z1
+        return self.ranges(level)["z"][1]
 
     def write_info_file(self, n_levels, voxel_size=(1800, 1800, 2000)):
         """Write the precomputed info file that defines the volume
@@ -185,7 +231,11 @@ class StackBase:
     def read_file(path):
         if '.jpeg' in path or '.jpg' in path:
             jarray = np.asarray(Image.open(path))
-            jarray[jarray < 20] = 0
+            if jarray.dtype == np.uint8:
+                return JPEG_LUT[jarray]
+            # PIL's array is read-only, so threshold a copy
+            jarray = jarray.copy()
+            np.putmask(jarray, jarray < JPEG_THRESHOLD, 0)
             return jarray
         else: return tifffile.imread(path)
 
@@ -254,8 +304,10 @@ class Stack(StackBase):
         for (x0a, x1a), (y0a, y1a) in itertools.product(
                 zip(x0, x1), zip(y0, y1)):
             path = Stack.sfname(dest, 1, x0a, x1a, y0a, y1a, z0a, z1a)
-            tifffile.imsave(path, img[:z1a - z0a, y0a:y1a, x0a:x1a],
-                            compress=4)
+            tifffile.imsave(
+                path,
+                np.ascontiguousarray(img[:z1a - z0a, y0a:y1a, x0a:x1a]),
+                compress=TIFF_COMPRESS_LEVEL)
 
     def write_level_n(self, level, silent=False,
                       n_cores = min(os.cpu_count(), 12)):
@@ -283,32 +335,33 @@ class Stack(StackBase):
         xsi_max = self.n_x(level - 1)
         ysi_max = self.n_y(level - 1)
         zsi_max = self.n_z(level - 1)
-        with multiprocessing.Pool(n_cores) as pool:
-            futures = []
-            for xidx, yidx, zidx in itertools.product(
-                    range(self.n_x(level)),
-                    range(self.n_y(level)),
-                    range(self.n_z(level))):
-                futures.append(pool.apply_async(
-                    Stack.write_one_level_n,
-                    (dest, dtype, level, x0d, x0s, x1d, x1s, xidx, xsi_max,
-                     y0d, y0s, y1d, y1s, yidx, ysi_max,
-                     z0d, z0s, z1d, z1s, zidx, zsi_max,
-                     self.cx(), self.cy(), self.cz())))
-            for future in tqdm.tqdm(futures):
-                future.get()
+        args = (dest, dtype, level, x0d, x0s, x1d, x1s, xsi_max,
+                y0d, y0s, y1d, y1s, ysi_max,
+                z0d, z0s, z1d, z1s, zsi_max,
+                self.cx(), self.cy(), self.cz())
+        tasks = list(itertools.product(
+            range(self.n_x(level)),
+            range(self.n_y(level)),
+            range(self.n_z(level))))
+        chunksize = max(1, len(tasks) // (n_cores * 4))
+        with multiprocessing.Pool(n_cores,
+                                  initializer=init_level_n_worker,
+                                  initargs=(args,)) as pool:
+            for _ in tqdm.tqdm(
+                    pool.imap_unordered(write_one_level_n_star, tasks,
+                                        chunksize=chunksize),
+                    total=len(tasks), disable=silent):
+                pass
 
     @staticmethod
-    def write_one_level_n(dest, dtype, level, x0d, x0s, x1d, x1s, xidx, xsi_max,
-                          y0d, y0s, y1d, y1s, yidx, ysi_max,
-                          z0d, z0s, z1d, z1s, zidx, zsi_max,
-                          cx, cy, cz):
+    def write_one_level_n(xidx, yidx, zidx):
+        dest, dtype, level, x0d, x0s, x1d, x1s, xsi_max, \
+            y0d, y0s, y1d, y1s, ysi_max, \
+            z0d, z0s, z1d, z1s, zsi_max, \
+            cx, cy, cz = LEVEL_N_ARGS
         block = np.zeros((z1d[zidx] - z0d[zidx],
                           y1d[yidx] - y0d[yidx],
-                          x1d[xidx] - x0d[xidx]), np.uint64)
-        hits = np.zeros((z1d[zidx] - z0d[zidx],
-                         y1d[yidx] - y0d[yidx],
-                         x1d[xidx] - x0d[xidx]), np.uint64)
+                          x1d[xidx] - x0d[xidx]), dtype)
         hx, hy, hz = cx // 2, cy // 2, cz // 2
         for xsi1, ysi1, zsi1 in itertools.product((0, 1), (0, 1), (0, 1)):
             xsi = xsi1 + xidx * 2
@@ -324,23 +377,13 @@ class Stack(StackBase):
                 dest, level - 1, x0s[xsi], x1s[xsi], y0s[ysi], y1s[ysi],
                 z0s[zsi], z1s[zsi])
             src_block = StackBase.read_file(src_path)
-            for offx, offy, offz in \
-                    itertools.product((0, 1), (0, 1), (0, 1)):
-                dsblock = src_block[offz::2, offy::2, offx::2]
-                block[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                xsi1 * hx:xsi1 * hx + dsblock.shape[2]] += \
-                    dsblock.astype(block.dtype)
-                hits[zsi1 * hz:zsi1 * hz + dsblock.shape[0],
-                ysi1 * hy:ysi1 * hy + dsblock.shape[1],
-                xsi1 * hx:xsi1 * hx + dsblock.shape[2]] += 1
-        block[hits > 0] = block[hits > 0] // hits[hits > 0]
+            dz, dy, dx = downsampled_shape(src_block.shape)
+            downsample_mean(src_block,
+                            block[zsi1 * hz:zsi1 * hz + dz,
+                                  ysi1 * hy:ysi1 * hy + dy,
+                                  xsi1 * hx:xsi1 * hx + dx])
         dest_path = Stack.sfname(
             dest, level, x0d[xidx], x1d[xidx], y0d[yidx], y1d[yidx],
             z0d[zidx], z1d[zidx])
-        tifffile.imsave(dest_path,
-                        block[:,
-                        :y1d[yidx] - y0d[yidx],
-                        :x1d[xidx] - x0d[xidx]].astype(dtype),
-                        compress=4)
+        tifffile.imsave(dest_path, block, compress=TIFF_COMPRESS_LEVEL)
         
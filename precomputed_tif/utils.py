@@ -19,9 +19,13 @@ def make_case(dtype, shape, return_path=False, klass=Stack,
     :return: the precomputed_tif.Stack and numpy 3-d volume that form the
              test case.
     """
-    imax = np.iinfo(dtype).max
-    npstack = np.random.RandomState(1234).randint(
-        0, imax, size=shape).astype(dtype)
+    if np.dtype(dtype).kind == "f":
+        npstack = np.random.RandomState(1234).uniform(
+            size=shape).astype(dtype)
+    else:
+        imax = np.iinfo(dtype).max
+        npstack = np.random.RandomState(1234).randint(
+            0, imax, size=shape).astype(dtype)
     tempdir = tempfile.mkdtemp()
     src = os.path.join(tempdir, "src")
     os.mkdir(src)
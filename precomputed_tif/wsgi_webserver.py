@@ -33,6 +33,7 @@ import json
 import os
 import pathlib
 import logging
+import re
 
 import typing
 
@@ -53,6 +54,20 @@ class ParseFilenameError(BaseException):
 
 
 CONFIG_FILE_DICT = {}
+SOURCES_DICT = {}
+
+#
+# The most bytes of a chunk handed to the server at once. A big chunk goes
+# out in pieces so that only a piece, not the whole chunk, is copied into
+# bytes at a time, whatever the chunk's shape.
+#
+BODY_BLOCK_BYTES = 1 << 20
+
+#
+# A chunk filename, e.g. "2_2_2/0-64_64-128_0-64", giving the level
+# directory and x0, x1, y0, y1, z0, z1
+#
+FILENAME_RE = re.compile(r"^([^/]+)/(\d+)-(\d+)_(\d+)-(\d+)_(\d+)-(\d+)$")
 
 
 def get_config(config_file:str)->typing.Sequence[dict]:
@@ -65,9 +80,18 @@ def get_config(config_file:str)->typing.Sequence[dict]:
     with path.open() as fd:
         config = json.load(fd)
     CONFIG_FILE_DICT[config_file] = (config, mtime)
+    sources = {}
+    for source in config:
+        sources.setdefault(source["name"], source)
+    SOURCES_DICT[config_file] = sources
     return config
 
 
+def get_source(config_file:str, name:str)->typing.Optional[dict]:
+    get_config(config_file)
+    return SOURCES_DICT[config_file].get(name)
+
+
 def serve_directory(start_response, config_file):
     config = get_config(config_file)
     head = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
@@ -94,112 +118,117 @@ def serve_directory(start_response, config_file):
 
 
 def serve_precomputed(environ, start_response, config_file):
-    config = get_config(config_file)
     path_info = environ["PATH_INFO"]
     if path_info == "/":
         return serve_directory(start_response, config_file)
-    for source in config:
-        if path_info[1:].startswith(source["name"]+"/"):
-            try:
-                filename = path_info[2+len(source["name"]):]
-                dest = os.path.join(source["directory"])
-                if filename == "mesh/info":
-                    return file_not_found(filename, start_response)
-                elif filename == "info":
-                    logging.info("Serving %s" % source["name"])
-                    destpath = os.path.join(dest, "info")
-                    if not os.path.exists(destpath):
-                        return file_not_found(destpath, start_response)
-                    with open(destpath, "rb") as fd:
-                        data = fd.read()
-                    start_response(
-                        "200 OK",
-                        [("Content-type", "application/json"),
-                         ("Content-Length", str(len(data))),
-                         ('Access-Control-Allow-Origin', '*')])
-                    return [data]
-                elif source["format"] == "tiff":
-                    import tifffile
-                    path = os.path.join(dest, filename+".tiff")
-                    if not os.path.exists(path):
-                        return file_not_found(path, start_response)
-                    img = tifffile.imread(path)
-                    data = img.tostring("C")
-                    start_response(
-                        "200 OK",
-                        [("Content-type", "application/octet-stream"),
-                         ("Content-Length", str(len(data))),
-                         ('Access-Control-Allow-Origin', '*')])
-                    return [data]
-                elif source["format"] == "zarr":
-                    import zarr
-                    filename, x0, x1, y0, y1, z0, z1 = \
-                        parse_filename(dest, filename)
-                    if not os.path.exists(filename):
-                        return file_not_found(filename, start_response)
-                    store = zarr.NestedDirectoryStore(filename)
-                    z_arr = zarr.open(store, mode='r')
-                    chunk = z_arr[z0:z1, y0:y1, x0:x1]
-                    data = chunk.tostring("C")
-                    start_response(
-                        "200 OK",
-                        [("Content-type", "application/octet-stream"),
-                         ("Content-Length", str(len(data))),
-                         ('Access-Control-Allow-Origin', '*')])
-                    return [data]
-                elif source["format"] == "blockfs":
-                    from blockfs import Directory
-                    filename, x0, x1, y0, y1, z0, z1 = \
-                        parse_filename(dest, filename)
-                    filename = os.path.join(filename, "precomputed.blockfs")
-                    directory = Directory.open(filename)
-                    chunk = directory.read_block(x0, y0, z0)
-                    data = chunk.tostring("C")
-                    start_response(
-                        "200 OK",
-                        [("Content-type", "application/octet-stream"),
-                         ("Content-Length", str(len(data))),
-                         ('Access-Control-Allow-Origin', '*')])
-                    return [data]
-                elif source["format"] == "ngff":
-                    import zarr
-                    filename, x0, x1, y0, y1, z0, z1 = \
-                        parse_filename(dest, filename)
-                    root, level = os.path.split(filename)
-                    lx, ly, lz = [int(_) for _ in level.split("_")]
-                    llevel = int(np.round(np.log2(lx), 0))
-                    store = zarr.NestedDirectoryStore(root)
-                    group = zarr.group(store)
-                    a = group[llevel]
-                    _, _, zs, ys, xs = a.chunks
-                    z1 = min(a.shape[2], z0 + zs)
-                    y1 = min(a.shape[3], y0 + ys)
-                    x1 = min(a.shape[4], x0 + xs)
-                    chunk = a[0, 0, z0:z1, y0:y1, x0:x1]
-                    data = chunk.tostring("C")
-                    start_response(
-                        "200 OK",
-                        [("Content-type", "application/octet-stream"),
-                         ("Content-Length", str(len(data))),
-                         ('Access-Control-Allow-Origin', '*')])
-                    return [data]
-            except ParseFilenameError:
-                return file_not_found(path_info, start_response)
-    else:
+    name, sep, filename = path_info[1:].partition("/")
+    source = get_source(config_file, name)
+    if source is None or not sep:
+        return file_not_found(path_info, start_response)
+    try:
+        dest = os.path.join(source["directory"])
+        if filename == "mesh/info":
+            return file_not_found(filename, start_response)
+        elif filename == "info":
+            logging.info("Serving %s" % source["name"])
+            destpath = os.path.join(dest, "info")
+            if not os.path.exists(destpath):
+                return file_not_found(destpath, start_response)
+            etag = file_etag(destpath)
+            if environ.get("HTTP_IF_NONE_MATCH") == etag:
+                start_response(
+                    "304 Not Modified",
+                    [("ETag", etag),
+                     ('Access-Control-Allow-Origin', '*')])
+                return []
+            with open(destpath, "rb") as fd:
+                data = fd.read()
+            start_response(
+                "200 OK",
+                [("Content-type", "application/json"),
+                 ("Content-Length", str(len(data))),
+                 ("ETag", etag),
+                 ('Access-Control-Allow-Origin', '*')])
+            return [data]
+        elif source["format"] == "tiff":
+            import tifffile
+            path = os.path.join(dest, filename+".tiff")
+            if not os.path.exists(path):
+                return file_not_found(path, start_response)
+            img = tifffile.imread(path)
+            return send_chunk(img, start_response)
+        elif source["format"] == "zarr":
+            import zarr
+            filename, x0, x1, y0, y1, z0, z1 = \
+                parse_filename(dest, filename)
+            if not os.path.exists(filename):
+                return file_not_found(filename, start_response)
+            store = zarr.NestedDirectoryStore(filename)
+            z_arr = zarr.open(store, mode='r')
+            chunk = z_arr[z0:z1, y0:y1, x0:x1]
+            return send_chunk(chunk, start_response)
+        elif source["format"] == "blockfs":
+            from blockfs import Directory
+            filename, x0, x1, y0, y1, z0, z1 = \
+                parse_filename(dest, filename)
+            filename = os.path.join(filename, "precomputed.blockfs")
+            directory = Directory.open(filename)
+            chunk = directory.read_block(x0, y0, z0)
+            return send_chunk(chunk, start_response)
+        elif source["format"] == "ngff":
+            import zarr
+            filename, x0, x1, y0, y1, z0, z1 = \
+                parse_filename(dest, filename)
+            root, level = os.path.split(filename)
+            lx, ly, lz = [int(_) for _ in level.split("_")]
+            llevel = int(np.round(np.log2(lx), 0))
+            store = zarr.NestedDirectoryStore(root)
+            group = zarr.group(store)
+            a = group[llevel]
+            _, _, zs, ys, xs = a.chunks
+            z1 = min(a.shape[2], z0 + zs)
+            y1 = min(a.shape[3], y0 + ys)
+            x1 = min(a.shape[4], x0 + xs)
+            chunk = a[0, 0, z0:z1, y0:y1, x0:x1]
+            return send_chunk(chunk, start_response)
+    except ParseFilenameError:
         return file_not_found(path_info, start_response)
+    return file_not_found(path_info, start_response)
+
+
+def file_etag(path:str)->str:
+    """An ETag for a file that changes whenever the file does
+
+    It is made from the file's modification time and size, so checking it
+    does not read the file.
+    """
+    stat = os.stat(path)
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def send_chunk(chunk:np.ndarray, start_response)->typing.Iterator[bytes]:
+    """Start the response for a chunk and return its body
+
+    The body is the little-endian, C-ordered bytes of the precomputed raw
+    encoding. It is produced BODY_BLOCK_BYTES at a time.
+    """
+    chunk = np.require(chunk, chunk.dtype.newbyteorder("<"), "C")
+    start_response(
+        "200 OK",
+        [("Content-type", "application/octet-stream"),
+         ("Content-Length", str(chunk.nbytes)),
+         ('Access-Control-Allow-Origin', '*')])
+    data = chunk.reshape(-1).view(np.uint8)
+    return (data[i:i + BODY_BLOCK_BYTES].tobytes()
+            for i in range(0, data.nbytes, BODY_BLOCK_BYTES))
 
 
 def parse_filename(dest, filename):
-    try:
-        level, path = filename.split("/")
-        filename = os.path.join(dest, level)
-        xstr, ystr, zstr = path.split("_")
-        x0, x1 = [int(x) for x in xstr.split('-')]
-        y0, y1 = [int(y) for y in ystr.split('-')]
-        z0, z1 = [int(z) for z in zstr.split('-')]
-    except ValueError:
+    match = FILENAME_RE.match(filename)
+    if match is None:
         raise ParseFilenameError()
-    return filename, x0, x1, y0, y1, z0, z1
+    level, *coords = match.groups()
+    return (os.path.join(dest, level), *(int(_) for _ in coords))
 
 
 def main():
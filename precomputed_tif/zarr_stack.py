@@ -8,6 +8,8 @@ from numcodecs import Blosc
 import os
 import tqdm
 
+from .downsample import downsample_mean, downsampled_shape
+
 
 """
 Default chunk size is (64, 64, 64)
@@ -244,10 +246,7 @@ class ZarrStack:
                 disable=silent):  # looping over destination block indicies (fewer blocks than source)
             block = np.zeros((z1d[zidx] - z0d[zidx],
                               y1d[yidx] - y0d[yidx],
-                              x1d[xidx] - x0d[xidx]), np.uint64)
-            hits = np.zeros((z1d[zidx] - z0d[zidx],
-                             y1d[yidx] - y0d[yidx],
-                             x1d[xidx] - x0d[xidx]), np.uint64)
+                              x1d[xidx] - x0d[xidx]), self.dtype)
             for xsi1, ysi1, zsi1 in itertools.product((0, 1), (0, 1), (0, 1)):  # looping over source blocks for this destination
                 xsi = xsi1 + xidx * 2
                 if xsi == self.n_x(level-1):  # Check for any source blocks that are out-of-bounds
@@ -262,18 +261,12 @@ class ZarrStack:
                 src_block = src_zarr[z0s[zsi]:z1s[zsi],
                                      y0s[ysi]:y1s[ysi],
                                      x0s[xsi]:x1s[xsi]]
-
-                for offx, offy, offz in \
-                        itertools.product((0, 1), (0, 1), (0,1)):
-                    dsblock = src_block[offz::2, offy::2, offx::2]
-                    block[zsi1*32:zsi1*32 + dsblock.shape[0],
-                          ysi1*32:ysi1*32 + dsblock.shape[1],
-                          xsi1*32:xsi1*32 + dsblock.shape[2]] += \
-                        dsblock.astype(block.dtype)  # 32 is half-block size of source
-                    hits[zsi1*32:zsi1*32 + dsblock.shape[0],
-                         ysi1*32:ysi1*32 + dsblock.shape[1],
-                         xsi1*32:xsi1*32 + dsblock.shape[2]] += 1
-            block[hits > 0] = block[hits > 0] // hits[hits > 0]
+                dz, dy, dx = downsampled_shape(src_block.shape)
+                # 32 is half-block size of source
+                downsample_mean(src_block,
+                                block[zsi1*32:zsi1*32 + dz,
+                                      ysi1*32:ysi1*32 + dy,
+                                      xsi1*32:xsi1*32 + dx])
 
             dest_zarr[z0d[zidx]:z1d[zidx],
                       y0d[yidx]:y1d[yidx],
@@ -1,10 +1,17 @@
+import itertools
 import numpy as np
 import os
+import shutil
+import tempfile
+import tifffile
 import unittest
 from precomputed_tif.blockfs_stack import BlockfsStack
+from precomputed_tif.stack import PType
 from precomputed_tif.utils import make_case
 from blockfs import Directory
 import logging
+from mp_shared_memory import SharedMemory
+from PIL import Image
 logging.basicConfig(level=logging.DEBUG)
 class TestBlockfsStack(unittest.TestCase):
     def test_write_oddly_shaped(self):
@@ -32,7 +39,56 @@ class TestBlockfsStack(unittest.TestCase):
                                           directory.read_block(0, 0, 0))
             np.testing.assert_array_equal(stack[128:, 128:, 128:],
                                           directory.read_block(128, 128, 128))
-    
-    
+
+    def test_write_segmentation_level_2(self):
+        with make_case(np.uint16, (100, 100, 100), return_path=True) \
+                as (glob_expr, dest, stack):
+            bfs = BlockfsStack(glob_expr, dest, ptype=PType.SEGMENTATION)
+            bfs.write_level_1(silent=True, n_cores=1)
+            bfs.write_level_n(2, silent=True, n_cores=1)
+            directory_filename = \
+                os.path.join(dest, "2_2_2", BlockfsStack.DIRECTORY_FILENAME)
+            directory = Directory.open(directory_filename)
+            block = directory.read_block(0, 0, 0)
+            self.assertEqual(block.dtype, stack.dtype)
+            expected = np.zeros((32, 32, 32), stack.dtype)
+            for z, y, x in itertools.product((0, 1), (0, 1), (0, 1)):
+                expected = np.maximum(expected, stack[z:64:2, y:64:2, x:64:2])
+            np.testing.assert_array_equal(block[:32, :32, :32], expected)
+
+    def test_write_bool(self):
+        stack = np.random.RandomState(1234).randint(0, 2, (70, 70, 70)) > 0
+        tempdir = tempfile.mkdtemp()
+        try:
+            for z in range(len(stack)):
+                tifffile.imsave(os.path.join(tempdir, "img_%04d.tiff" % z),
+                                stack[z])
+            dest = os.path.join(tempdir, "dest")
+            os.mkdir(dest)
+            bfs = BlockfsStack(os.path.join(tempdir, "img_*.tiff"), dest)
+            bfs.write_level_1(silent=True, n_cores=1)
+            directory_filename = \
+                os.path.join(dest, "1_1_1", BlockfsStack.DIRECTORY_FILENAME)
+            directory = Directory.open(directory_filename)
+            np.testing.assert_array_equal(
+                stack[:64, :64, :64].astype(np.uint16) * 100,
+                directory.read_block(0, 0, 0))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_read_jpeg(self):
+        img = np.random.RandomState(1234).randint(0, 256, (50, 60)) \
+            .astype(np.uint8)
+        shm = SharedMemory((2, 50, 60), np.uint16)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "img.jpg")
+            Image.fromarray(img).save(path)
+            expected = np.asarray(Image.open(path))
+            BlockfsStack.read_tiff(shm, 1, path)
+        with shm.txn() as m:
+            np.testing.assert_equal(m[1], np.where(expected < 20, 0, expected))
+
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import json
 import pathlib
@@ -26,6 +27,12 @@ class MockResponse:
     def read(self):
         return self.data
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
 
 class MockUrlOpen:
     """A class that mimics urllib.request.urlopen"""
@@ -78,9 +85,7 @@ class MockUrlOpen:
             if scale["key"] == directory:
                 (x0, x1), (y0, y1), (z0, z1) = [
                     map(int, _.split("-")) for _ in filename.split("_")]
-                xoff = scale["voxel_offset"][0]
-                yoff = scale["voxel_offset"][1]
-                zoff = scale["voxel_offset"][2]
+                xoff, yoff, zoff = scale.get("voxel_offset", (0, 0, 0))
                 xscale = scale["size"][0]
                 yscale = scale["size"][1]
                 zscale = scale["size"][2]
@@ -119,8 +124,13 @@ class MockUrlOpen:
 class TestClient(unittest.TestCase):
 
     def setUp(self):
+        self.max_cache_bytes = precomputed_tif.client.CHUNK_CACHE.max_bytes
+        precomputed_tif.client.set_cache_bytes(256 * 1024 * 1024)
         clear_cache(MockUrlOpen.BASE_URL)
 
+    def tearDown(self):
+        precomputed_tif.client.set_cache_bytes(self.max_cache_bytes)
+
     def test_read_all(self):
         with unittest.mock.patch(
                 "precomputed_tif.client.urlopen",
@@ -135,6 +145,85 @@ class TestClient(unittest.TestCase):
             data = read_chunk(mock.BASE_URL, 32, 96, 16, 80, 8, 72)
             np.testing.assert_array_equal(data, mock.data[8:72, 16:80, 32:96])
 
+    def test_read_serially(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            data = read_chunk(mock.BASE_URL, 32, 96, 16, 80, 8, 72,
+                              max_workers=1)
+            np.testing.assert_array_equal(data, mock.data[8:72, 16:80, 32:96])
+
+    def test_chunk_cache(self):
+        mock_urlopen = MockUrlOpen()
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                unittest.mock.Mock(wraps=mock_urlopen)) as mock:
+            read_chunk(mock_urlopen.BASE_URL, 0, 64, 0, 64, 0, 64)
+            n_calls = mock.call_count
+            data = read_chunk(mock_urlopen.BASE_URL, 10, 20, 10, 20, 10, 20)
+            self.assertEqual(mock.call_count, n_calls)
+            np.testing.assert_array_equal(
+                data, mock_urlopen.data[10:20, 10:20, 10:20])
+
+    def test_read_aligned(self):
+        mock_urlopen = MockUrlOpen()
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                unittest.mock.Mock(wraps=mock_urlopen)) as mock:
+            data = read_chunk(mock_urlopen.BASE_URL, 0, 64, 0, 64, 0, 64)
+            np.testing.assert_array_equal(data, mock_urlopen.data[:64, :64, :64])
+            # One call for the info file and one for the only chunk
+            self.assertEqual(mock.call_count, 2)
+
+    def test_read_inside_one_chunk(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            data = read_chunk(mock.BASE_URL, 5, 15, 6, 16, 7, 17)
+            np.testing.assert_array_equal(data, mock.data[7:17, 6:16, 5:15])
+            data[:] = 0
+            again = read_chunk(mock.BASE_URL, 5, 15, 6, 16, 7, 17)
+            np.testing.assert_array_equal(again, mock.data[7:17, 6:16, 5:15])
+
+    def test_chunk_cache_eviction(self):
+        cache = precomputed_tif.client.ChunkCache(100)
+        cache.put(("a", 1), np.zeros(60, np.uint8))
+        cache.put(("b", 1), np.zeros(60, np.uint8))
+        self.assertIsNone(cache.get(("a", 1)))
+        self.assertIsNotNone(cache.get(("b", 1)))
+        self.assertEqual(cache.nbytes, 60)
+        cache.clear("b")
+        self.assertIsNone(cache.get(("b", 1)))
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_aread_chunk(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            loop = asyncio.new_event_loop()
+            try:
+                data = loop.run_until_complete(
+                    precomputed_tif.client.aread_chunk(
+                        mock.BASE_URL, 32, 96, 16, 80, 8, 72))
+            finally:
+                loop.close()
+            np.testing.assert_array_equal(data, mock.data[8:72, 16:80, 32:96])
+
+    def test_set_cache_bytes(self):
+        cache = precomputed_tif.client.CHUNK_CACHE
+        max_bytes = cache.max_bytes
+        clear_cache()
+        try:
+            with unittest.mock.patch(
+                    "precomputed_tif.client.urlopen",
+                    MockUrlOpen()) as mock:
+                read_chunk(mock.BASE_URL, 0, 128, 0, 128, 0, 128)
+                self.assertEqual(cache.nbytes, 128 * 128 * 128 * 2)
+                precomputed_tif.client.set_cache_bytes(64 * 64 * 64 * 2)
+                self.assertEqual(cache.nbytes, 64 * 64 * 64 * 2)
+        finally:
+            precomputed_tif.client.set_cache_bytes(max_bytes)
+
     def test_offset(self):
         with unittest.mock.patch(
                 "precomputed_tif.client.urlopen",
@@ -143,6 +232,14 @@ class TestClient(unittest.TestCase):
             data = read_chunk(mock.BASE_URL, 30, 60, 30, 60, 30, 60)
             np.testing.assert_array_equal(data, mock.data[:30, 10:40, 20:50])
 
+    def test_no_offset(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            del mock.info["scales"][0]["voxel_offset"]
+            data = read_chunk(mock.BASE_URL, 32, 96, 16, 80, 8, 72)
+            np.testing.assert_array_equal(data, mock.data[8:72, 16:80, 32:96])
+
     def test_different_sizes(self):
         with unittest.mock.patch(
                 "precomputed_tif.client.urlopen",
@@ -151,6 +248,15 @@ class TestClient(unittest.TestCase):
             data = read_chunk(mock.BASE_URL, 0, 96, 0, 120, 0, 128)
             np.testing.assert_array_equal(data, mock.data[:128, :120, :96])
 
+    def test_get_scale(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            info = precomputed_tif.client.get_info(mock.BASE_URL)
+            self.assertEqual(info.get_scale(1).key, "1_1_1")
+            self.assertEqual(info.get_scale((1, 1, 1)).key, "1_1_1")
+            self.assertRaises(KeyError, info.get_scale, 2)
+
     def test_array_reader(self):
         with unittest.mock.patch(
                 "precomputed_tif.client.urlopen",
@@ -172,6 +278,32 @@ class TestClient(unittest.TestCase):
             np.testing.assert_array_equal(
                 data, mock.data[10:-108, 30:-88, 50:-68])
 
+    def test_array_reader_prefetch(self):
+        with unittest.mock.patch(
+                "precomputed_tif.client.urlopen",
+                MockUrlOpen()) as mock:
+            a = ArrayReader(mock.BASE_URL, prefetch_depth=2)
+            data = a[63, :64, :64]
+            np.testing.assert_array_equal(data, mock.data[63, :64, :64])
+            self.assertEqual(len(a.prefetch_futures), 2)
+            for future in a.prefetch_futures.values():
+                future.result()
+            key = (mock.BASE_URL, "1_1_1", "tiff", 0, 0, 64)
+            self.assertIsNotNone(
+                precomputed_tif.client.CHUNK_CACHE.get(key))
+
+    def test_array_reader_no_prefetch_ngff(self):
+        with make_case(np.uint16, (100, 201, 300), klass=NGFFStack,
+                       chunk_size=(128, 128, 128)) as (stack, npstack):
+            stack.create()
+            stack.write_info_file(1)
+            stack.write_level_1()
+            url = pathlib.Path(stack.dest).as_uri()
+            ar = ArrayReader(url, format="ngff")
+            data = ar[0:64, 0:64, 0:64]
+            np.testing.assert_array_equal(data, npstack[0:64, 0:64, 0:64])
+            self.assertEqual(len(ar.prefetch_futures), 0)
+
     def teesstt_file_array_reader(self, format, klass:StackBase):
         with make_case(np.uint16, (100, 201, 300), klass=klass)\
                 as (stack, npstack):
@@ -244,8 +376,9 @@ def make_sidecar(xoff, yoff, zoff, voxel_size):
 def make_dandi_case(y_offset,
                    old=True,
                    voxel_size=[2.564, 3.625, 2.564],
-                   levels=1):
-    with make_case(np.uint16, (100, 200, 300),
+                   levels=1,
+                   dtype=np.uint16):
+    with make_case(dtype, (100, 200, 300),
                    klass=NGFFStack,
                    destname="chunk1_spim.ngff") as (stack1, volume1):
         stack1.create()
@@ -253,7 +386,7 @@ def make_dandi_case(y_offset,
         stack1.write_level_1()
         for level in range(2, levels + 1):
             stack1.write_level_n(level)
-        with make_case(np.uint16, (100, 200, 300),
+        with make_case(dtype, (100, 200, 300),
                        klass=NGFFStack,
                        destname="chunk2_spim.ngff") as (stack2, volume2):
             stack2.create()
@@ -306,6 +439,22 @@ class TestDandi(unittest.TestCase):
             maxval = np.maximum(bottom, top)
             self.assertTrue(np.all((middle >= minval) & (middle <= maxval)))
 
+    def test_double_float32(self):
+        with make_dandi_case(100, dtype=np.float32) as \
+                ((url1, volume1), (url2, volume2)):
+            ar = DANDIArrayReader([url1, url2])
+            middle = ar[:10, 100:200, :10]
+            self.assertEqual(middle.dtype, np.float32)
+            bottom = volume1[:10, 100:, :10]
+            top = volume2[:10, :100, :10]
+            minval = np.minimum(bottom, top)
+            maxval = np.maximum(bottom, top)
+            self.assertTrue(np.all((middle >= minval) & (middle <= maxval)))
+            #
+            # The blend of values in [0, 1) is not floored to zero
+            #
+            self.assertTrue(np.any(middle != np.floor(middle)))
+
     def test_sidecar(self):
         with make_dandi_case(100, True) as ((url1, volume1), (url2, volume2)):
             ar = DANDIArrayReader([url1, url2])
@@ -0,0 +1,84 @@
+import itertools
+import numpy as np
+import unittest
+
+from precomputed_tif.downsample import downsample_mean, downsampled_shape
+
+
+def reference_mean(src):
+    """The mean of each 2x2x2 cube, computed the slow way"""
+    block = np.zeros(downsampled_shape(src.shape), np.uint64)
+    hits = np.zeros(block.shape, np.uint64)
+    for offx, offy, offz in itertools.product((0, 1), (0, 1), (0, 1)):
+        dsblock = src[offz::2, offy::2, offx::2]
+        block[:dsblock.shape[0], :dsblock.shape[1], :dsblock.shape[2]] += \
+            dsblock.astype(block.dtype)
+        hits[:dsblock.shape[0], :dsblock.shape[1], :dsblock.shape[2]] += 1
+    return (block // hits).astype(src.dtype)
+
+
+class TestDownsample(unittest.TestCase):
+    def test_downsampled_shape(self):
+        self.assertSequenceEqual(downsampled_shape((64, 63, 1)), (32, 32, 1))
+
+    def test_even(self):
+        src = np.random.RandomState(1234).randint(
+            0, 65535, (64, 64, 64)).astype(np.uint16)
+        out = np.zeros((32, 32, 32), np.uint16)
+        downsample_mean(src, out)
+        np.testing.assert_array_equal(out, reference_mean(src))
+
+    def test_odd(self):
+        src = np.random.RandomState(1234).randint(
+            0, 65535, (37, 20, 9)).astype(np.uint16)
+        out = np.zeros((19, 10, 5), np.uint16)
+        downsample_mean(src, out)
+        np.testing.assert_array_equal(out, reference_mean(src))
+
+    def test_into_view(self):
+        src = np.random.RandomState(1234).randint(
+            0, 255, (10, 10, 10)).astype(np.uint8)
+        block = np.zeros((10, 10, 10), np.uint8)
+        downsample_mean(src, block[5:, 5:, 5:])
+        np.testing.assert_array_equal(block[5:, 5:, 5:], reference_mean(src))
+        self.assertTrue(np.all(block[:5] == 0))
+
+    def test_uint32(self):
+        src = np.full((4, 4, 4), 2 ** 32 - 1, np.uint32)
+        out = np.zeros((2, 2, 2), np.uint32)
+        downsample_mean(src, out)
+        np.testing.assert_array_equal(out, src[::2, ::2, ::2])
+
+    def test_int16(self):
+        src = np.random.RandomState(1234).randint(
+            -32768, 32767, (37, 20, 9)).astype(np.int16)
+        out = np.zeros((19, 10, 5), np.int16)
+        downsample_mean(src, out)
+        expected = np.zeros(out.shape, np.int64)
+        hits = np.zeros(out.shape, np.int64)
+        for offx, offy, offz in itertools.product((0, 1), (0, 1), (0, 1)):
+            dsblock = src[offz::2, offy::2, offx::2]
+            expected[:dsblock.shape[0], :dsblock.shape[1],
+                     :dsblock.shape[2]] += dsblock
+            hits[:dsblock.shape[0], :dsblock.shape[1],
+                 :dsblock.shape[2]] += 1
+        np.testing.assert_array_equal(out, expected // hits)
+
+    def test_float32(self):
+        src = np.random.RandomState(1234).uniform(
+            -1, 1, (37, 20, 9)).astype(np.float32)
+        out = np.zeros((19, 10, 5), np.float32)
+        downsample_mean(src, out)
+        expected = np.zeros(out.shape, np.float64)
+        hits = np.zeros(out.shape, np.float64)
+        for offx, offy, offz in itertools.product((0, 1), (0, 1), (0, 1)):
+            dsblock = src[offz::2, offy::2, offx::2]
+            expected[:dsblock.shape[0], :dsblock.shape[1],
+                     :dsblock.shape[2]] += dsblock
+            hits[:dsblock.shape[0], :dsblock.shape[1],
+                 :dsblock.shape[2]] += 1
+        np.testing.assert_allclose(out, expected / hits, rtol=1e-6, atol=1e-7)
+
+
+if __name__ == '__main__':
+    unittest.main()
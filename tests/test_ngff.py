@@ -1,11 +1,15 @@
 import itertools
 import json
+import multiprocessing
 import os
 import numpy as np
 import unittest
+import unittest.mock
 import zarr
 
+import precomputed_tif.ngff_stack
 from precomputed_tif.ngff_stack import NGFFStack
+from precomputed_tif.stack import PType
 from precomputed_tif.utils import make_case
 
 
@@ -96,6 +100,72 @@ class TestNGFFStack(unittest.TestCase):
                     s32[-1, -1, -1]) / 4
             self.assertLessEqual(abs(block[-1, -1, -1]- last), 1)
 
+    def test_write_level_2_float32(self):
+        with make_case(np.float32, (100, 201, 300), klass=NGFFStack) \
+                as (stack, npstack):
+            stack.create()
+            stack.write_info_file(2)
+            stack.write_level_1()
+            stack.write_level_n(2)
+            block = stack.zgroup["1"][0, 0]
+            self.assertEqual(block.dtype, np.float32)
+            expected = npstack.astype(np.float64)[:, :200].reshape(
+                50, 2, 100, 2, 150, 2).mean(axis=(1, 3, 5))
+            np.testing.assert_allclose(block[:, :100], expected, rtol=1e-6)
+
+    def test_write_level_2_segmentation(self):
+        with make_case(np.uint16, (100, 201, 300), klass=NGFFStack) \
+                as (stack, npstack):
+            stack.ptype = PType.SEGMENTATION
+            stack.create()
+            stack.write_info_file(2)
+            stack.write_level_1()
+            stack.write_level_n(2)
+            #
+            # Each label is the voxel at (2i+1, 2j+1, 2k+1). Y is odd, so
+            # the last row takes the last row of the source.
+            #
+            expected = npstack[1::2, 1::2, 1::2]
+            expected = np.concatenate(
+                (expected, npstack[1::2, -1:, 1::2]), axis=1)
+            np.testing.assert_equal(stack.zgroup["1"][0, 0], expected)
+
+    def test_shared_pool(self):
+        with make_case(np.uint16, (100, 201, 300), klass=NGFFStack) \
+                as (stack, npstack):
+            stack.create()
+            stack.write_info_file(2)
+            with multiprocessing.Pool(2) as pool:
+                stack.write_level_1(silent=True, pool=pool)
+                stack.write_level_n(2, silent=True, pool=pool)
+            np.testing.assert_equal(stack.zgroup["0"][0, 0], npstack)
+            self.assertSequenceEqual(stack.zgroup["1"].shape,
+                                     (1, 1, 50, 101, 150))
+            self.assertTrue(np.any(stack.zgroup["1"][0, 0] != 0))
+
+    def test_datasets_opened_once(self):
+        class SerialPool:
+            def imap_unordered(self, fn, tasks, chunksize=1):
+                return map(fn, tasks)
+
+        with make_case(np.uint16, (100, 201, 300), klass=NGFFStack) \
+                as (stack, npstack):
+            stack.create()
+            stack.write_info_file(2)
+            datasets = precomputed_tif.ngff_stack.DATASETS
+            datasets.clear()
+            try:
+                with unittest.mock.patch(
+                        "precomputed_tif.ngff_stack.zarr.open",
+                        wraps=zarr.open) as mock:
+                    stack.write_level_1(silent=True, pool=SerialPool())
+                    stack.write_level_n(2, silent=True, pool=SerialPool())
+                    self.assertEqual(mock.call_count, 2)
+            finally:
+                datasets.clear()
+            np.testing.assert_equal(stack.zgroup["0"][0, 0], npstack)
+            self.assertTrue(np.any(stack.zgroup["1"][0, 0] != 0))
+
 
 if __name__ == '__main__':
     unittest.main()
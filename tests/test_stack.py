@@ -4,6 +4,9 @@ import tifffile
 import itertools
 import json
 import os
+import tempfile
+from PIL import Image
+from precomputed_tif.stack import StackBase
 from precomputed_tif.utils import make_case
 
 class TestStack(unittest.TestCase):
@@ -32,6 +35,14 @@ class TestStack(unittest.TestCase):
             self.assertSequenceEqual(stack.x0(2).tolist(), (0, 64, 128))
             self.assertSequenceEqual(stack.x1(2).tolist(), (64, 128, 150))
 
+    def test_ranges(self):
+        with make_case(np.uint16, (100, 200, 300)) as (stack, npstack):
+            ranges = stack.ranges(2)
+            self.assertIs(ranges, stack.ranges(2))
+            self.assertSequenceEqual(ranges["y"].tolist(),
+                                     [[0, 64], [64, 100]])
+            self.assertFalse(stack.x0(2).flags.writeable)
+
     def test_write_info_file(self):
         with make_case(np.uint16, (101, 200, 300)) as (stack, npstack):
             stack.write_info_file(2)
@@ -81,6 +92,17 @@ class TestStack(unittest.TestCase):
                     s32[-1, -1, -1]) // 4
             self.assertEqual(block[-1, -1, -1], last)
 
+    def test_read_jpeg(self):
+        img = np.random.RandomState(1234).randint(0, 256, (50, 60)) \
+            .astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "img.jpg")
+            Image.fromarray(img).save(path)
+            expected = np.asarray(Image.open(path))
+            result = StackBase.read_file(path)
+        np.testing.assert_equal(result, np.where(expected < 20, 0, expected))
+        self.assertTrue(result.flags.writeable)
+
 
 if __name__ == '__main__':
     unittest.main()